@@ -0,0 +1,59 @@
+"""
+Benchmark of the vectorized engineer_features/get_zones against the original row-wise implementations.
+
+Usage (from the repository root):
+    python -m benchmarks.bench_features --repeat 20
+"""
+import argparse
+import os
+import time
+import pandas as pd
+from utils import preprocessing
+
+
+def load_sorted(file_path, repeat):
+    # Stack copies of the file with distinct game ids to get a bigger, still realistic frame
+    data = preprocessing.filter_regular_season(pd.read_csv(file_path))
+    copies = []
+    for i in range(repeat):
+        copy = data.copy()
+        copy['game_pk'] = copy['game_pk'] + i * 10_000_000
+        copies.append(copy)
+    data = pd.concat(copies, ignore_index=True)
+    data = preprocessing.add_plate_app_id(data)
+    return preprocessing.sort_data(data)
+
+
+def time_stage(function, data, runs):
+    best = float('inf')
+    for _ in range(runs):
+        copy = data.copy()
+        start = time.perf_counter()
+        function(copy)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--file', default=os.path.join('data', 'raw', 'wade_miley.csv'))
+    parser.add_argument('--repeat', type=int, default=10, help='number of copies of the file to stack')
+    parser.add_argument('--runs', type=int, default=3, help='timed runs per stage; the best one is reported')
+    args = parser.parse_args()
+
+    data = load_sorted(args.file, args.repeat)
+    engineered = preprocessing.engineer_features(data.copy())
+    stages = [
+        ('engineer_features', preprocessing.engineer_features_reference, preprocessing.engineer_features, data),
+        ('get_zones', preprocessing.get_zones_reference, preprocessing.get_zones, engineered),
+    ]
+    print(f'{len(data)} pitches')
+    for name, reference, vectorized, frame in stages:
+        reference_time = time_stage(reference, frame, args.runs)
+        vectorized_time = time_stage(vectorized, frame, args.runs)
+        print(f'{name}: reference {reference_time * 1000:.1f} ms, vectorized {vectorized_time * 1000:.1f} ms, '
+              f'{reference_time / vectorized_time:.1f}x faster')
+
+
+if __name__ == '__main__':
+    main()
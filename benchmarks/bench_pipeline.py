@@ -0,0 +1,179 @@
+"""
+Time and memory profile of the preprocessing -> sequencing -> training pipeline on synthetic data.
+
+Every stage reports its wall time and its peak traced memory (for model_fit from a separate traced epoch, so the
+timed one runs at full speed); the results are written as JSON so runs on different commits can be compared.
+Training and prediction stages are skipped when tensorflow is not installed.
+
+Usage (from the repository root):
+    python -m benchmarks.bench_pipeline --pitches 50000 --output bench.json
+"""
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+from benchmarks.synthetic import write_statcast
+from utils import preprocessing
+from utils.sequencer import Sequencer
+
+RESEARCH_UTILS = os.path.join('notebooks', 'replicating_research', 'utils')
+
+
+def load_research_module(name):
+    # The research notebooks have their own utils package, which would clash with ours on import
+    spec = importlib.util.spec_from_file_location(f'research_{name}', os.path.join(RESEARCH_UTILS, f'{name}.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def profile(results, name, function, *args, trace=True, **kwargs):
+    """
+    Run function once, record its wall time and peak traced allocations in results[name], and return its output.
+    tracemalloc slows every allocation down, so with trace=False only the wall time is recorded.
+    """
+    if trace:
+        tracemalloc.start()
+    start = time.perf_counter()
+    output = function(*args, **kwargs)
+    seconds = time.perf_counter() - start
+    results[name] = {'seconds': seconds}
+    if trace:
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        results[name]['peak_mb'] = peak / 2 ** 20
+        print(f'{name}: {seconds * 1000:.1f} ms, peak {peak / 2 ** 20:.1f} MB')
+    else:
+        print(f'{name}: {seconds * 1000:.1f} ms')
+    return output
+
+
+def build_model(input_shape, num_pitches, num_vertical_locs, num_horizontal_locs, units):
+    # Small version of the LSTM ensemble from the notebooks
+    import tensorflow as tf
+    input_layer = tf.keras.Input(shape=input_shape)
+    outputs = []
+    for name, num_targets in [('pitch', num_pitches), ('vertical', num_vertical_locs),
+                              ('horizontal', num_horizontal_locs)]:
+        x = tf.keras.layers.LSTM(units, name=f'{name}_hidden_1')(input_layer)
+        outputs.append(tf.keras.layers.Dense(num_targets, activation='softmax', name=f'{name}_output')(x))
+    model = tf.keras.models.Model(inputs=input_layer, outputs=outputs)
+    model.compile(optimizer='adam',
+                  loss={'pitch_output': 'categorical_crossentropy',
+                        'vertical_output': 'categorical_crossentropy',
+                        'horizontal_output': 'categorical_crossentropy'},
+                  metrics=['accuracy', 'accuracy', 'accuracy'])
+    return model
+
+
+def bench_model(results, sequences, batch_size, fit_steps, units):
+    try:
+        import tensorflow as tf  # noqa: F401
+    except ImportError:
+        results['model_fit'] = results['predict_latency'] = {'skipped': 'tensorflow is not installed'}
+        print('Skipping model stages: tensorflow is not installed')
+        return
+    X, y_pitch, y_vertical, y_horizontal = [array.astype(np.float32) for array in sequences]
+    n = min(len(X), batch_size * fit_steps)
+    model = build_model(X.shape[1:], y_pitch.shape[1], y_vertical.shape[1], y_horizontal.shape[1], units)
+    targets = {'pitch_output': y_pitch[:n], 'vertical_output': y_vertical[:n], 'horizontal_output': y_horizontal[:n]}
+    # The first epoch includes tracing and compilation, so only the second one is timed. It runs without tracemalloc,
+    # which would slow it down, and the peak memory is taken from a third, traced epoch
+    model.fit(X[:n], targets, batch_size=batch_size, epochs=1, verbose=0)
+    profile(results, 'model_fit', model.fit, X[:n], targets, batch_size=batch_size, epochs=1, verbose=0, trace=False)
+    results['model_fit']['steps_per_second'] = (n // batch_size) / results['model_fit']['seconds']
+    profile(results, 'model_fit_traced', model.fit, X[:n], targets, batch_size=batch_size, epochs=1, verbose=0)
+    results['model_fit']['peak_mb'] = results.pop('model_fit_traced')['peak_mb']
+
+    latencies = []
+    for i in range(100):
+        start = time.perf_counter()
+        model(X[i: i + 1], training=False)
+        latencies.append(time.perf_counter() - start)
+    results['predict_latency'] = {'p50_ms': float(np.percentile(latencies, 50) * 1000),
+                                  'p99_ms': float(np.percentile(latencies, 99) * 1000)}
+    start = time.perf_counter()
+    model.predict(X[:n], batch_size=1024, verbose=0)
+    results['predict_latency']['batch_samples_per_second'] = n / (time.perf_counter() - start)
+    print(f"predict: p50 {results['predict_latency']['p50_ms']:.2f} ms, "
+          f"p99 {results['predict_latency']['p99_ms']:.2f} ms")
+
+
+def run(n_pitches, max_length=6, batch_size=64, fit_steps=50, units=64, seed=0):
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_path = write_statcast(os.path.join(tmp_dir, 'synthetic.csv'), n_pitches, seed=seed)
+
+        raw = profile(results, 'read_csv', pd.read_csv, file_path)
+        data = preprocessing.filter_regular_season(raw)
+        data = preprocessing.sort_data(preprocessing.add_plate_app_id(data))
+        data = profile(results, 'engineer_features', preprocessing.engineer_features, data)
+        data = preprocessing.select_features(data)
+        data = profile(results, 'get_dummies', pd.get_dummies, data,
+                       columns=['previous_zone', 'previous_pitch', 'inning'], dtype=int)
+        data = preprocessing.get_zones(data)
+        data = pd.get_dummies(data, columns=['pitch_type', 'vertical_location', 'horizontal_location'], dtype=int)
+        n_pitch_types = len([col for col in data.columns if col.startswith('pitch_type_')])
+        seq = Sequencer(data=data, max_length=max_length, n_features=0, n_pitch_types=n_pitch_types,
+                        n_vertical_locs=3, n_horizontal_locs=3)
+        sequences = profile(results, 'make_sequences', seq.make_sequences)
+        results['make_sequences']['samples'] = len(sequences[0])
+        for mode in ('all', 'sliding'):
+            compact = profile(results, f'make_compact_{mode}', seq.make_compact, mode, 'int8')
+            results[f'make_compact_{mode}']['samples'] = len(compact)
+
+        research_preprocessing = load_research_module('preprocessing')
+        research_sequencer = load_research_module('sequencer')
+        research_data, repertoire = research_preprocessing.preprocess_data(file_path)
+        research_data = pd.get_dummies(research_data, columns=['pitch_type'], dtype=int).drop(columns=['zone'])
+        research_seq = research_sequencer.Sequencer(data=research_data, max_length=max_length,
+                                                    n_features=research_data.shape[1] - len(repertoire),
+                                                    n_pitch_types=len(repertoire))
+        profile(results, 'research_make_sequences', research_seq.make_sequences)
+
+    bench_model(results, sequences, batch_size, fit_steps, units)
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pitches', type=int, default=20000, help='number of synthetic pitches')
+    parser.add_argument('--max-length', type=int, default=6)
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--fit-steps', type=int, default=50, help='training steps in the timed epoch')
+    parser.add_argument('--units', type=int, default=64, help='LSTM units per head of the benchmark model')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='JSON file for the results; printed to stdout when not given')
+    args = parser.parse_args()
+
+    report = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'config': vars(args),
+        'stages': run(args.pitches, args.max_length, args.batch_size, args.fit_steps, args.units, args.seed),
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
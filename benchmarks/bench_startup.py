@@ -0,0 +1,107 @@
+"""
+Cold start of the CLI subcommands.
+
+Every run is a fresh Python process, so the numbers include interpreter start and all imports. For each command the
+median wall time, the peak RSS and the heavy packages that ended up imported are reported. The predict command is
+only run when a .tflite model is given; otherwise the import cost of its code path is measured on its own.
+Importing the training modules (utils.callbacks, utils.search, ...) is checked not to load tensorflow.
+
+Usage (from the repository root):
+    python -m benchmarks.bench_startup --repeats 5 [--tflite model.tflite] --output startup.json
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+from benchmarks.synthetic import write_statcast
+
+HEAVY_MODULES = ['tensorflow', 'pandas', 'matplotlib', 'sklearn', 'keras_tuner']
+
+# Reports the heavy packages imported and the peak RSS on the last stderr line. VmHWM (in kilobytes) is reset by exec,
+# unlike the ru_maxrss of wait4, which keeps the peak of the forked parent
+REPORT = ('print(json.dumps({"imports": [name for name in %r if name in sys.modules], '
+          '"rss_kb": int([line for line in open("/proc/self/status") if line.startswith("VmHWM")][0].split()[1])}), '
+          'file=sys.stderr)\n' % HEAVY_MODULES)
+
+# Runs the CLI
+RUNNER = ('import json, sys\n'
+          'from utils.cli import main\n'
+          'main(sys.argv[1:])\n' + REPORT)
+
+
+def import_only(modules):
+    # Code that imports modules and reports the heavy packages they pulled in
+    return f'import json, sys\nimport {modules}\n' + REPORT
+
+
+# Import cost of the predict code path on its own
+PREDICT_IMPORTS = import_only('numpy, utils.cli, utils.lite')
+
+# Modules the training and search code imports before it needs tensorflow
+TRAINING_IMPORTS = import_only('utils.callbacks, utils.search, utils.orchestrator, utils.models')
+
+
+def run_once(code, args):
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, '-c', code, *args], stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                            text=True)
+    seconds = time.perf_counter() - start
+    if result.returncode != 0:
+        raise RuntimeError(f'Command {args} failed:\n{result.stderr}')
+    report = json.loads(result.stderr.strip().splitlines()[-1])
+    return seconds, report['rss_kb'] / 1024, report['imports']
+
+
+def measure(name, code, args, repeats):
+    runs = [run_once(code, args) for _ in range(repeats)]
+    result = {'seconds': float(np.median([seconds for seconds, _, _ in runs])),
+              'peak_rss_mb': float(max(rss for _, rss, _ in runs)),
+              'heavy_imports': runs[-1][2]}
+    print(f"{name}: {result['seconds'] * 1000:.0f} ms, peak RSS {result['peak_rss_mb']:.0f} MB, "
+          f"imports {result['heavy_imports']}")
+    return result
+
+
+def run(repeats, n_pitches, tflite=None):
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        raw_csv = write_statcast(os.path.join(tmp_dir, 'synthetic.csv'), n_pitches)
+        results['python'] = measure('python', 'import json, sys\n' + REPORT, [], repeats)
+        results['preprocess'] = measure('preprocess', RUNNER,
+                                        ['preprocess', raw_csv, os.path.join(tmp_dir, 'features.npz')], repeats)
+        results['sequence'] = measure('sequence', RUNNER,
+                                      ['sequence', raw_csv, os.path.join(tmp_dir, 'sequences')], repeats)
+        results['predict_imports'] = measure('predict_imports', PREDICT_IMPORTS, [], repeats)
+        results['training_imports'] = measure('training_imports', TRAINING_IMPORTS, [], repeats)
+        # tensorflow must only be imported by the code that builds or runs a model
+        assert 'tensorflow' not in results['training_imports']['heavy_imports']
+        if tflite:
+            results['predict'] = measure('predict', RUNNER,
+                                         ['predict', tflite, os.path.join(tmp_dir, 'sequences', 'X.npy'),
+                                          os.path.join(tmp_dir, 'predictions.npz')], repeats)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--pitches', type=int, default=2000, help='number of synthetic pitches')
+    parser.add_argument('--tflite', help='exported model for timing the predict subcommand')
+    parser.add_argument('--output', help='JSON file for the results; printed to stdout when not given')
+    args = parser.parse_args()
+
+    report = {'python': sys.version.split()[0], 'config': vars(args),
+              'commands': run(args.repeats, args.pitches, args.tflite)}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+"""
+Synthetic Statcast-shaped pitch data for benchmarks, so they run without downloading real exports.
+"""
+import numpy as np
+import pandas as pd
+
+# Share of plate appearances by number of pitches, roughly as in MLB data
+DEFAULT_AT_BAT_LENGTHS = {1: 0.12, 2: 0.14, 3: 0.15, 4: 0.16, 5: 0.15, 6: 0.13, 7: 0.08, 8: 0.04, 9: 0.02, 10: 0.01}
+
+DEFAULT_REPERTOIRE = {
+    'FF': ('4-Seam Fastball', 0.40), 'SL': ('Slider', 0.20), 'CH': ('Changeup', 0.15),
+    'CU': ('Curveball', 0.12), 'SI': ('Sinker', 0.10), 'FC': ('Cutter', 0.03),
+}
+
+ZONES = np.array([1, 2, 3, 4, 5, 6, 7, 8, 9, 11, 12, 13, 14])
+
+
+def make_statcast(n_pitches, at_bat_lengths=None, repertoire=None, at_bats_per_game=25, spring_share=0.02, seed=0):
+    """
+    Generate a frame with the raw Statcast columns the preprocessing pipeline reads.
+    Args
+        n_pitches: approximate number of rows; whole plate appearances are generated, so it may be slightly larger.
+        at_bat_lengths: dict mapping the number of pitches in a plate appearance to its probability.
+        repertoire: dict mapping a pitch type to (pitch name, probability).
+        at_bats_per_game: plate appearances per game.
+        spring_share: share of games that are spring training (game_type 'S') and get filtered out.
+        seed: random seed.
+    Returns
+        data: DataFrame in the order of a Statcast export (latest pitch first).
+    """
+    rng = np.random.default_rng(seed)
+    at_bat_lengths = at_bat_lengths or DEFAULT_AT_BAT_LENGTHS
+    repertoire = repertoire or DEFAULT_REPERTOIRE
+
+    lengths_p = np.array(list(at_bat_lengths.values()), dtype=float)
+    mean_length = np.dot(list(at_bat_lengths.keys()), lengths_p / lengths_p.sum())
+    n_at_bats = int(np.ceil(n_pitches / mean_length))
+    lengths = rng.choice(list(at_bat_lengths.keys()), size=n_at_bats, p=lengths_p / lengths_p.sum())
+
+    # Plate appearance level columns
+    at_bat = np.arange(n_at_bats)
+    game = at_bat // at_bats_per_game
+    n_games = game[-1] + 1
+    game_pk = 700000 + game
+    game_date = pd.Timestamp('2024-03-28') + pd.to_timedelta(game, unit='D')
+    game_type = np.where(rng.random(n_games) < spring_share, 'S', 'R')[game]
+    at_bat_number = at_bat % at_bats_per_game + 1
+    inning = np.minimum(9, (at_bat_number - 1) // 3 + 1)
+    inning_topbot = np.where(rng.random(n_games) < 0.5, 'Top', 'Bot')[game]
+    batter = rng.integers(600000, 700000, size=n_at_bats)
+    outs = rng.integers(0, 3, size=n_at_bats)
+    home_score = rng.poisson(0.25 * inning)
+    away_score = rng.poisson(0.25 * inning)
+    on_base = [np.where(rng.random(n_at_bats) < p, rng.integers(600000, 700000, size=n_at_bats), np.nan)
+               for p in (0.08, 0.18, 0.28)]
+
+    # Pitch level columns
+    rows = np.repeat(at_bat, lengths)
+    starts = np.cumsum(lengths) - lengths
+    pitch_number = np.arange(len(rows)) - np.repeat(starts, lengths) + 1
+    is_ball = rng.random(len(rows)) < 0.4
+    # Count before each pitch: balls and strikes thrown earlier in the at-bat, capped at 3-2
+    balls = np.cumsum(is_ball) - is_ball
+    strikes = np.cumsum(~is_ball) - ~is_ball
+    balls = np.minimum(3, balls - np.repeat(balls[starts], lengths))
+    strikes = np.minimum(2, strikes - np.repeat(strikes[starts], lengths))
+
+    pitch_types = np.array(list(repertoire.keys()))
+    pitch_p = np.array([p for _, p in repertoire.values()], dtype=float)
+    pitch_codes = rng.choice(len(pitch_types), size=len(rows), p=pitch_p / pitch_p.sum())
+    pitch_names = np.array([name for name, _ in repertoire.values()])
+
+    data = pd.DataFrame({
+        'pitch_type': pitch_types[pitch_codes],
+        'game_date': game_date[rows].strftime('%Y-%m-%d'),
+        'batter': batter[rows],
+        'zone': rng.choice(ZONES, size=len(rows)).astype(float),
+        'game_type': game_type[rows],
+        'balls': balls,
+        'strikes': strikes,
+        'on_3b': on_base[0][rows],
+        'on_2b': on_base[1][rows],
+        'on_1b': on_base[2][rows],
+        'outs_when_up': outs[rows],
+        'inning': inning[rows],
+        'inning_topbot': inning_topbot[rows],
+        'game_pk': game_pk[rows],
+        'at_bat_number': at_bat_number[rows],
+        'pitch_number': pitch_number,
+        'pitch_name': pitch_names[pitch_codes],
+        'home_score': home_score[rows],
+        'away_score': away_score[rows],
+    })
+    # Statcast exports list the latest pitch first
+    return data.iloc[::-1].reset_index(drop=True)
+
+
+def write_statcast(file_path, n_pitches, **kwargs):
+    make_statcast(n_pitches, **kwargs).to_csv(file_path)
+    return file_path
@@ -115,3 +115,77 @@ class Sequencer:
         y_test = np.concatenate([result[1] for result in test_sequences])
 
         return X_train, X_val, X_test, y_train, y_val, y_test
+
+    def _split_of_rows(self, units, ratios):
+        """
+        Assign every row to train (0), validation (1) or test (2) so that all rows of a unit land in the same split.
+        Units are taken in order of first appearance, which is chronological for a frame from sort_data, and a unit goes
+        to the split its first row falls in under the row-position split of make_sequences.
+        """
+        test_split_ratio, val_split_ratio = ratios
+        n_rows = len(units)
+        train_val_size = int(n_rows * test_split_ratio)
+        train_size = int(train_val_size * val_split_ratio)
+        _, first_rows, unit_of_row = np.unique(units, return_index=True, return_inverse=True)
+        unit_split = np.searchsorted([train_size, train_val_size], first_rows, side='right')
+        return unit_split[unit_of_row.ravel()]
+
+    def make_split_sequences(self, split_by='plate_app', dates=None, ratios=(0.8, 0.9)):
+        """
+        Vectorized, single-pass version of make_sequences with splits that never cut an at-bat.
+        All windows are built into one tensor ordered by split, so every split is a contiguous slice and
+        X[splits['train']] is a view rather than a copy. Within a split, windows come in the same order as the groupby
+        in make_sequences.
+        Args
+            split_by: 'plate_app' keeps each plate appearance in one split; 'date' keeps each game date in one split,
+                so no game day is shared between training and testing.
+            dates: game date of every row, required for split_by='date' (e.g. the raw game_date column, aligned with
+                the rows of the data).
+            ratios: the test and validation ratios of make_sequences (80/20, then 90/10 of the first part).
+        Returns
+            X: (s, max_length, n_features) windows of every split.
+            y: (s, n_pitch_types) labels.
+            splits: dict mapping 'train', 'val' and 'test' to slices of X and y.
+        """
+        data_arr = self.data.to_numpy(dtype=np.float64)
+        ids = data_arr[:, 0]
+        if split_by == 'plate_app':
+            row_split = self._split_of_rows(ids, ratios)
+        elif split_by == 'date':
+            if dates is None:
+                raise ValueError("dates are required for split_by='date'")
+            row_split = self._split_of_rows(np.asarray(dates), ratios)
+        else:
+            raise ValueError(f"split_by must be 'plate_app' or 'date', got {split_by!r}")
+
+        # Rows grouped by split, then plate appearance, then pitch number
+        pitch_number_col = self.data.columns.get_loc('pitch_number')
+        order = np.lexsort((data_arr[:, pitch_number_col], ids, row_split))
+        data_arr, ids, row_split = data_arr[order], ids[order], row_split[order]
+        boundaries = np.flatnonzero((np.diff(ids) != 0) | (np.diff(row_split) != 0)) + 1
+        starts = np.concatenate([[0], boundaries])
+        ends = np.concatenate([boundaries, [len(ids)]])
+
+        # Every slice [i, j) of an at-bat, broken into windows of at most max_length pitches
+        length = self.max_length
+        n_rows = len(ids)
+        n_slices = np.repeat(ends, ends - starts) - np.arange(n_rows)
+        slice_starts = np.repeat(np.arange(n_rows), n_slices)
+        slice_offsets = np.arange(len(slice_starts)) - np.repeat(np.cumsum(n_slices) - n_slices, n_slices)
+        slice_ends = slice_starts + slice_offsets + 1
+        n_windows = (slice_ends - slice_starts + length - 1) // length
+        window_starts = np.repeat(slice_starts, n_windows) + length * (
+            np.arange(n_windows.sum()) - np.repeat(np.cumsum(n_windows) - n_windows, n_windows))
+        window_ends = np.minimum(window_starts + length, np.repeat(slice_ends, n_windows))
+
+        # One gather for the features of every window; the appended zero row pads the short ones
+        features = data_arr[:, 1: -self.n_pitch_types]
+        features = np.vstack([features, np.zeros((1, features.shape[1]))])
+        index = window_starts[:, None] + np.arange(length)
+        X = features[np.where(index < window_ends[:, None], index, n_rows)]
+        y = data_arr[window_ends - 1, -self.n_pitch_types:]
+
+        split_bounds = np.searchsorted(row_split[window_starts], [0, 1, 2, 3])
+        splits = {name: slice(int(split_bounds[i]), int(split_bounds[i + 1]))
+                  for i, name in enumerate(['train', 'val', 'test'])}
+        return X, y, splits
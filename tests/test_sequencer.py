@@ -0,0 +1,73 @@
+"""
+Parity of the vectorized Sequencer against the original groupby implementation.
+Run from the repository root with: python -m pytest tests
+"""
+import os
+import numpy as np
+import pytest
+from utils.preprocessing import make_sequencer
+from utils.sequencer import Sequencer
+
+RAW_CSV = os.path.join(os.path.dirname(__file__), os.pardir, 'data', 'raw', 'wade_miley.csv')
+N_AT_BATS = 300
+
+
+@pytest.fixture(scope='module')
+def seq():
+    # The first N_AT_BATS plate appearances of the sample pitcher, long enough to hold at-bats over max_length
+    full = make_sequencer(RAW_CSV, max_length=6)
+    plate_app_ids = full.data['plate_app_id'].unique()[:N_AT_BATS]
+    data = full.data[full.data['plate_app_id'].isin(plate_app_ids)]
+    assert data['plate_app_id'].value_counts().max() > full.max_length
+    return Sequencer(data=data,
+                     max_length=full.max_length,
+                     n_features=full.n_features,
+                     n_pitch_types=full.n_pitch_types,
+                     n_vertical_locs=full.n_vertical_locs,
+                     n_horizontal_locs=full.n_horizontal_locs)
+
+
+def windows_by_pitch(seq, mode):
+    # Plain-loop construction of the one-window-per-pitch modes, written from their definitions
+    plate_app_ids, data_arr = seq._sorted_arrays()
+    padded_features, labels = seq._split_arrays(data_arr)
+    X, y = [], []
+    for plate_app_id in np.unique(plate_app_ids):
+        rows = np.flatnonzero(plate_app_ids == plate_app_id)
+        for i, end in enumerate(rows + 1):
+            if mode == 'prefix':
+                start = rows[0] + i // seq.max_length * seq.max_length
+            else:
+                start = max(rows[0], end - seq.max_length)
+            window = np.zeros((seq.max_length, padded_features.shape[1]))
+            window[: end - start] = padded_features[start: end]
+            X.append(window)
+            y.append(labels[end - 1])
+    y = np.array(y)
+    n_pitch, n_vertical = seq.n_pitch_types, seq.n_vertical_locs
+    return (np.array(X, dtype=padded_features.dtype), y[:, :n_pitch], y[:, n_pitch: n_pitch + n_vertical],
+            y[:, n_pitch + n_vertical:])
+
+
+def assert_same(actual, expected):
+    assert len(actual) == len(expected)
+    for a, e in zip(actual, expected):
+        assert a.shape == e.shape
+        np.testing.assert_array_equal(a, e)
+
+
+def test_all_matches_reference(seq):
+    assert_same(seq.make_sequences(), seq.make_sequences_reference())
+
+
+@pytest.mark.parametrize('mode', ['prefix', 'sliding'])
+def test_window_per_pitch_modes(seq, mode):
+    assert_same(seq.make_sequences(mode), windows_by_pitch(seq, mode))
+
+
+@pytest.mark.parametrize('mode', ['all', 'prefix', 'sliding'])
+def test_compact_matches_make_sequences(seq, mode):
+    compact = seq.make_compact(mode)
+    assert_same(compact.gather(), seq.make_sequences(mode))
+    batches = list(compact.iter_batches(batch_size=97))
+    assert_same([np.concatenate(parts) for parts in zip(*batches)], seq.make_sequences(mode))
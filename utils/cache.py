@@ -0,0 +1,149 @@
+import hashlib
+import json
+import os
+import numpy as np
+import pandas as pd
+
+# Bump when the preprocessing pipeline changes in a way that makes old entries wrong
+CACHE_VERSION = 2
+
+
+def file_fingerprint(file_path, block_size=1 << 20):
+    # Hash the file contents in blocks so large exports are never fully loaded
+    digest = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def frame_to_arrays(data):
+    """
+    Split a DataFrame into plain numpy arrays that np.savez can store without pickling.
+    Numeric columns are kept as they are; every other column is stored as category codes plus its categories.
+    """
+    arrays = {'columns': np.array(data.columns, dtype=str), 'index': data.index.to_numpy()}
+    for i, col in enumerate(data.columns):
+        values = data[col]
+        if pd.api.types.is_numeric_dtype(values) and not pd.api.types.is_bool_dtype(values):
+            arrays[f'col_{i}'] = values.to_numpy()
+        else:
+            categorical = pd.Categorical(values)
+            arrays[f'codes_{i}'] = categorical.codes
+            arrays[f'categories_{i}'] = np.array(categorical.categories, dtype=str)
+    return arrays
+
+
+def arrays_to_frame(arrays):
+    # Inverse of frame_to_arrays
+    columns = {}
+    for i, col in enumerate(arrays['columns']):
+        if f'col_{i}' in arrays:
+            columns[col] = arrays[f'col_{i}']
+        else:
+            categorical = pd.Categorical.from_codes(arrays[f'codes_{i}'], arrays[f'categories_{i}'])
+            columns[col] = np.asarray(categorical, dtype=object)
+    return pd.DataFrame(columns, index=arrays['index'])
+
+
+class FeatureCache:
+    """
+    On-disk cache of preprocessed feature frames and sequence tensors.
+    Entries are .npz files keyed by a hash of the raw file contents and the pipeline parameters, so editing the raw
+    file or changing a parameter misses the old entry automatically. Least recently used entries are evicted once the
+    directory grows past max_bytes.
+    Args
+        cache_dir: directory holding the entries.
+        max_bytes: size limit of the directory.
+    """
+    def __init__(self, cache_dir=os.path.join('data', 'cache'), max_bytes=2 * 1024 ** 3) -> None:
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._fingerprints = {}
+
+    def _fingerprint(self, file_path):
+        # Re-hash only when the file's size or modification time changes
+        stat = os.stat(file_path)
+        stamp = (stat.st_size, stat.st_mtime_ns)
+        cached = self._fingerprints.get(file_path)
+        if cached is None or cached[0] != stamp:
+            cached = (stamp, file_fingerprint(file_path))
+            self._fingerprints[file_path] = cached
+        return cached[1]
+
+    def key(self, file_path, kind, **params):
+        """
+        Build the cache key of a file and a set of pipeline parameters.
+        Args
+            file_path: raw Statcast csv the entry is derived from.
+            kind: 'features' or 'sequences'.
+            params: pipeline parameters such as max_length or the dummy column vocabulary. Must be JSON serializable.
+        """
+        payload = json.dumps({'version': CACHE_VERSION,
+                              'file': self._fingerprint(file_path),
+                              'kind': kind,
+                              'params': params}, sort_keys=True, default=str)
+        return f'{kind}_{hashlib.sha1(payload.encode()).hexdigest()}'
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f'{key}.npz')
+
+    def load(self, key):
+        """
+        Return the arrays stored under key, or None on a miss.
+        A hit refreshes the entry's modification time, which is what LRU eviction orders by.
+        """
+        path = self._path(key)
+        if not os.path.exists(path):
+            return None
+        with np.load(path, allow_pickle=False) as entry:
+            arrays = {name: entry[name] for name in entry.files}
+        os.utime(path)
+        return arrays
+
+    def save(self, key, arrays):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self._path(key)
+        # Write to a temporary file first so a crash never leaves a truncated entry behind
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def load_frame(self, key):
+        arrays = self.load(key)
+        return None if arrays is None else arrays_to_frame(arrays)
+
+    def save_frame(self, key, data):
+        self.save(key, frame_to_arrays(data))
+
+    def load_sequences(self, key):
+        arrays = self.load(key)
+        if arrays is None:
+            return None
+        return arrays['X'], arrays['y_pitch'], arrays['y_vertical'], arrays['y_horizontal']
+
+    def save_sequences(self, key, sequences):
+        X, y_pitch, y_vertical, y_horizontal = sequences
+        self.save(key, {'X': X, 'y_pitch': y_pitch, 'y_vertical': y_vertical, 'y_horizontal': y_horizontal})
+
+    def evict(self):
+        # Remove least recently used entries until the directory fits in max_bytes
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.npz'):
+                stat = os.stat(os.path.join(self.cache_dir, name))
+                entries.append((stat.st_mtime_ns, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.remove(os.path.join(self.cache_dir, name))
+            total -= size
+
+    def clear(self):
+        if os.path.isdir(self.cache_dir):
+            for name in os.listdir(self.cache_dir):
+                if name.endswith('.npz'):
+                    os.remove(os.path.join(self.cache_dir, name))
@@ -1,9 +1,20 @@
-import tensorflow as tf
+import json
+import os
+import time
 import numpy as np
+from utils import instrumentation
+from utils.lazy import LazyModule
 
-class FreezeOutputCallback(tf.keras.callbacks.Callback):
+tf = LazyModule('tensorflow')
+
+# The callbacks subclass tf.keras.callbacks.Callback, which would import tensorflow together with this module. Their
+# methods live in the plain classes below, and the Keras classes FreezeOutputCallback, InstrumentationCallback and
+# _HeadMonitor are created from them on first use (see __getattr__ at the end of the module).
+
+
+class _FreezeOutputMethods:
     def __init__(self, patience=5):
-        super(FreezeOutputCallback, self).__init__()
+        super().__init__()
         self.patience = patience
         self.best_val_accuracies = {}
         self.wait = {}
@@ -45,4 +56,254 @@ class FreezeOutputCallback(tf.keras.callbacks.Callback):
         for layer in self.model.layers:
             if layer.name.startswith(output_name):
                 layer.trainable = False
-        print(f"\nFreezing output {output_name} at {epoch + 1} epochs.")
\ No newline at end of file
+        instrumentation.count(f'training.freeze.{output_name}')
+        instrumentation.gauge(f'training.freeze_epoch.{output_name}', epoch + 1)
+        print(f"\nFreezing output {output_name} at {epoch + 1} epochs.")
+
+
+class _InstrumentationMethods:
+    """
+    Records training throughput and per-head metrics in utils.instrumentation.
+    Batch and epoch wall times go to the training.batch/training.epoch timers, throughput to the
+    training.samples_per_second gauge and every value in the epoch logs (e.g. val_pitch_output_accuracy) to a
+    training.<metric> gauge. Throughput only counts the time spent in training batches, so validation and other
+    callbacks do not lower it. Does nothing unless instrumentation is enabled.
+    Args
+        batch_size: batch size passed to fit, used to convert steps into samples.
+        export_path: optional JSONL file that receives a snapshot at the end of every epoch.
+        n_samples: optional number of training samples per epoch, e.g. len(train_idx). When given, the last partial
+            batch of an epoch counts its real length instead of batch_size.
+    """
+    def __init__(self, batch_size, export_path=None, n_samples=None):
+        super().__init__()
+        self.batch_size = batch_size
+        self.export_path = export_path
+        self.n_samples = n_samples
+        self.batch_start = None
+        self.epoch_start = None
+        self.epoch_samples = 0
+        self.train_seconds = 0.0
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.epoch_start = time.perf_counter()
+        self.epoch_samples = 0
+        self.train_seconds = 0.0
+
+    def _batch_length(self, batch):
+        # Samples in step batch of the epoch; only the last step of an epoch can be shorter than batch_size
+        if self.n_samples is None:
+            return self.batch_size
+        return max(0, min(self.batch_size, self.n_samples - batch * self.batch_size))
+
+    def on_train_batch_begin(self, batch, logs=None):
+        if instrumentation.is_enabled():
+            self.batch_start = time.perf_counter()
+
+    def on_train_batch_end(self, batch, logs=None):
+        if instrumentation.is_enabled() and self.batch_start is not None:
+            seconds = time.perf_counter() - self.batch_start
+            length = self._batch_length(batch)
+            self.train_seconds += seconds
+            self.epoch_samples += length
+            instrumentation.observe('training.batch', seconds)
+            instrumentation.count('training.samples', length)
+
+    def on_epoch_end(self, epoch, logs=None):
+        if not instrumentation.is_enabled():
+            return
+        instrumentation.observe('training.epoch', time.perf_counter() - self.epoch_start)
+        if self.train_seconds > 0:
+            instrumentation.gauge('training.samples_per_second', self.epoch_samples / self.train_seconds)
+        instrumentation.gauge('training.epoch', epoch + 1)
+        for key, value in (logs or {}).items():
+            instrumentation.gauge(f'training.{key}', float(value))
+        if self.export_path:
+            instrumentation.export_jsonl(self.export_path)
+
+
+class _HeadMonitorMethods:
+    # Reports every epoch to a HeadFreezeController and stops fit as soon as a head freezes
+    def __init__(self, controller):
+        super().__init__()
+        self.controller = controller
+
+    def on_epoch_end(self, epoch, logs=None):
+        if self.controller.update(epoch, logs or {}):
+            self.model.stop_training = True
+
+
+class HeadFreezeController:
+    """
+    Trains a three-head ensemble and freezes every head on its own, like FreezeOutputCallback, but a frozen head is
+    also dropped from the computation.
+    Training runs in segments. When a head stops improving for patience epochs, its best weights are restored, its
+    layers are made non-trainable and fit stops; the next segment compiles a model with only the remaining heads'
+    outputs, so the frozen branch no longer runs in the forward or backward pass. At the end every head holds its
+    best weights.
+    With checkpoint_dir, the model weights, the best weights of every head and the controller state are saved after
+    every epoch, and a new controller on the same directory resumes from there.
+    Args
+        model: compiled model with pitch_output, vertical_output and horizontal_output; head layers are named
+            <head>_... as built by the notebooks' build_network.
+        patience: epochs without a better val_<head>_output_accuracy before the head freezes.
+        checkpoint_dir: optional directory for the resumable state.
+        loss: loss of every head in the recompiled models.
+    """
+    def __init__(self, model, patience=5, checkpoint_dir=None, loss='categorical_crossentropy'):
+        self.model = model
+        self.patience = patience
+        self.checkpoint_dir = checkpoint_dir
+        self.loss = loss
+        self.heads = [layer.name[:-len('_output')] for layer in model.layers if layer.name.endswith('_output')]
+        self.best_val_accuracies = {head: -np.inf for head in self.heads}
+        self.wait = {head: 0 for head in self.heads}
+        self.best_weights = {}
+        self.frozen_outputs = []
+        self.epoch = 0
+        self.history = {}
+        if checkpoint_dir and os.path.exists(os.path.join(checkpoint_dir, 'state.json')):
+            self._load()
+
+    def active_heads(self):
+        return [head for head in self.heads if head not in self.frozen_outputs]
+
+    def _head_layers(self, head):
+        return [layer for layer in self.model.layers if layer.name.startswith(f'{head}_')]
+
+    def _training_model(self):
+        # The full model while every head trains, otherwise a model over the same layers with the active heads only
+        active = self.active_heads()
+        if len(active) == len(self.heads):
+            return self.model
+        outputs = {f'{head}_output': self.model.get_layer(f'{head}_output').output for head in active}
+        model = tf.keras.models.Model(inputs=self.model.inputs, outputs=outputs)
+        optimizer = self.model.optimizer.__class__.from_config(self.model.optimizer.get_config())
+        model.compile(optimizer=optimizer,
+                      loss={name: self.loss for name in outputs},
+                      metrics={name: ['accuracy'] for name in outputs})
+        return model
+
+    def _select(self, y):
+        # Keep the labels of the active heads only
+        return {f'{head}_output': y[f'{head}_output'] for head in self.active_heads()}
+
+    def update(self, epoch, logs):
+        """
+        Record the validation accuracies of an epoch and freeze the heads that ran out of patience.
+        Returns
+            the heads frozen at this epoch.
+        """
+        active = self.active_heads()
+        newly_frozen = []
+        for head in active:
+            val_acc = logs.get(f'val_{head}_output_accuracy')
+            if val_acc is None and len(active) == 1:
+                # Keras drops the output name from the metrics of a single-output model
+                val_acc = logs.get('val_accuracy')
+            if val_acc is None:
+                continue
+            if val_acc > self.best_val_accuracies[head]:
+                self.best_val_accuracies[head] = val_acc
+                self.wait[head] = 0
+                self.best_weights[head] = [layer.get_weights() for layer in self._head_layers(head)]
+            else:
+                self.wait[head] += 1
+                if self.wait[head] >= self.patience:
+                    newly_frozen.append(head)
+        for head in newly_frozen:
+            self.freeze_output(head, epoch)
+        for key, value in logs.items():
+            if len(active) == 1 and not key.endswith('_output_accuracy') and 'accuracy' in key:
+                key = key.replace('accuracy', f'{active[0]}_output_accuracy')
+            self.history.setdefault(key, []).append(float(value))
+        self.epoch = epoch + 1
+        self._save()
+        return newly_frozen
+
+    def restore_best_weights(self, head):
+        for layer, weights in zip(self._head_layers(head), self.best_weights.get(head, [])):
+            layer.set_weights(weights)
+
+    def freeze_output(self, output_name, epoch):
+        self.restore_best_weights(output_name)
+        for layer in self._head_layers(output_name):
+            layer.trainable = False
+        self.frozen_outputs.append(output_name)
+        instrumentation.count(f'training.freeze.{output_name}')
+        instrumentation.gauge(f'training.freeze_epoch.{output_name}', epoch + 1)
+        print(f"\nFreezing output {output_name} at {epoch + 1} epochs.")
+
+    def fit(self, x, y, validation_data, epochs=100, batch_size=64, callbacks=None, verbose=0):
+        """
+        Train until every head is frozen or epochs is reached; arguments as in the notebooks' model.fit calls, with y
+        and the validation labels as dicts keyed by output name.
+        Returns
+            history: dict of per-epoch logs over all segments, with the notebooks' metric names.
+        """
+        X_val, y_val = validation_data
+        while self.epoch < epochs and self.active_heads():
+            model = self._training_model()
+            model.fit(x, self._select(y), validation_data=(X_val, self._select(y_val)), epochs=epochs,
+                      initial_epoch=self.epoch, batch_size=batch_size,
+                      callbacks=[_callback_class('_HeadMonitor')(self)] + list(callbacks or []), verbose=verbose)
+        for head in self.active_heads():
+            self.restore_best_weights(head)
+        return self.history
+
+    def _save(self):
+        if not self.checkpoint_dir:
+            return
+        os.makedirs(self.checkpoint_dir, exist_ok=True)
+        self.model.save_weights(os.path.join(self.checkpoint_dir, 'model.weights.h5'))
+        for head, layers_weights in self.best_weights.items():
+            arrays = {f'{i}_{j}': weight for i, weights in enumerate(layers_weights) for j, weight in enumerate(weights)}
+            np.savez(os.path.join(self.checkpoint_dir, f'{head}_best.npz'), **arrays)
+        state = {'epoch': self.epoch, 'best_val_accuracies': self.best_val_accuracies, 'wait': self.wait,
+                 'frozen_outputs': self.frozen_outputs, 'history': self.history}
+        # Write to a temporary file first so a crash never leaves a half-written state
+        path = os.path.join(self.checkpoint_dir, 'state.json')
+        with open(f'{path}.tmp', 'w') as f:
+            json.dump(state, f, default=float)
+        os.replace(f'{path}.tmp', path)
+
+    def _load(self):
+        with open(os.path.join(self.checkpoint_dir, 'state.json')) as f:
+            state = json.load(f)
+        self.model.load_weights(os.path.join(self.checkpoint_dir, 'model.weights.h5'))
+        self.epoch = state['epoch']
+        self.best_val_accuracies = state['best_val_accuracies']
+        self.wait = state['wait']
+        self.history = state['history']
+        for head in self.heads:
+            path = os.path.join(self.checkpoint_dir, f'{head}_best.npz')
+            if os.path.exists(path):
+                with np.load(path) as arrays:
+                    self.best_weights[head] = [[arrays[f'{i}_{j}'] for j in range(len(layer.get_weights()))]
+                                               for i, layer in enumerate(self._head_layers(head))]
+        for head in state['frozen_outputs']:
+            for layer in self._head_layers(head):
+                layer.trainable = False
+            self.frozen_outputs.append(head)
+        print(f'Resuming training at epoch {self.epoch} with frozen outputs {self.frozen_outputs}.')
+
+
+_CALLBACK_METHODS = {'FreezeOutputCallback': _FreezeOutputMethods,
+                     'InstrumentationCallback': _InstrumentationMethods,
+                     '_HeadMonitor': _HeadMonitorMethods}
+
+
+def _callback_class(name):
+    # Keras callback class with the methods of _CALLBACK_METHODS[name], created once and then kept in the module
+    cls = globals().get(name)
+    if cls is None:
+        methods = _CALLBACK_METHODS[name]
+        cls = type(name, (methods, tf.keras.callbacks.Callback), {'__module__': __name__, '__doc__': methods.__doc__})
+        globals()[name] = cls
+    return cls
+
+
+def __getattr__(name):
+    # from utils.callbacks import FreezeOutputCallback imports tensorflow only at this point
+    if name in _CALLBACK_METHODS:
+        return _callback_class(name)
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
@@ -0,0 +1,127 @@
+"""
+Command line interface of the pipeline.
+
+    python -m utils.cli preprocess data/raw/gerrit_cole.csv features.npz
+    python -m utils.cli sequence data/raw/gerrit_cole.csv sequences/gerrit_cole
+    python -m utils.cli train sequences/gerrit_cole models/gerrit_cole.keras --cell gru
+    python -m utils.cli predict models/gerrit_cole.tflite sequences/gerrit_cole/X.npy predictions.npz
+
+Every subcommand imports what it needs when it runs, so preprocess never loads tensorflow and predict on a .tflite
+model loads neither tensorflow nor pandas. benchmarks/bench_startup.py measures the cold start of each subcommand.
+"""
+import argparse
+import os
+import sys
+
+
+def preprocess(args):
+    from utils import preprocessing
+    from utils.cache import FeatureCache, frame_to_arrays
+    import numpy as np
+
+    cache = FeatureCache(args.cache_dir) if args.cache_dir else None
+    categories = preprocessing.scan_categories(args.raw_csv) if args.fixed_vocabulary else None
+    data = preprocessing.preprocess_data(args.raw_csv, cache=cache, categories=categories)
+    np.savez(args.output, **frame_to_arrays(data))
+    print(f'Wrote {len(data)} pitches with {data.shape[1]} columns to {args.output}')
+
+
+def sequence(args):
+    from utils import preprocessing
+
+    shapes = preprocessing.write_sequences(args.raw_csv, args.out_dir, max_length=args.max_length, dtype=args.dtype)
+    print(f'Wrote sequences with shapes {shapes} to {args.out_dir}')
+
+
+def train(args):
+    from utils.orchestrator import set_thread_budget
+    if args.threads:
+        set_thread_budget(args.threads)
+    from utils.callbacks import FreezeOutputCallback
+    from utils.datasets import SequenceBatches
+    from utils.models import build_model
+    from utils.sequence_store import open_sequences, split_indices
+
+    X, y_pitch, y_vertical, y_horizontal = open_sequences(args.sequences_dir)
+    train_idx, val_idx, _ = split_indices(len(X))
+    model = build_model(input_shape=X.shape[1:], num_pitches=y_pitch.shape[1], num_vertical_locs=y_vertical.shape[1],
+                        num_horizontal_locs=y_horizontal.shape[1], cell=args.cell)
+    model.fit(SequenceBatches(X, y_pitch, y_vertical, y_horizontal, indices=train_idx, batch_size=args.batch_size,
+                              shuffle=True, seed=args.seed),
+              epochs=args.epochs,
+              validation_data=SequenceBatches(X, y_pitch, y_vertical, y_horizontal, indices=val_idx,
+                                              batch_size=args.batch_size),
+              callbacks=[FreezeOutputCallback(patience=args.patience)],
+              verbose=args.verbose)
+    os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+    model.save(args.output)
+    print(f'Saved model to {args.output}')
+
+
+def predict(args):
+    import numpy as np
+
+    if args.model.endswith('.tflite'):
+        from utils.lite import LitePredictor
+        predict_fn = LitePredictor(args.model, num_threads=args.threads or 1)
+    else:
+        import tensorflow as tf
+        from utils.inference import keras_predict_fn
+        predict_fn = keras_predict_fn(tf.keras.models.load_model(args.model))
+    X = np.load(args.windows, mmap_mode='r')
+    outputs = {'pitch': [], 'vertical': [], 'horizontal': []}
+    for start in range(0, len(X), args.batch_size):
+        for head, probs in zip(outputs, predict_fn(np.asarray(X[start: start + args.batch_size], dtype=np.float32))):
+            outputs[head].append(probs)
+    np.savez(args.output, **{head: np.concatenate(parts) for head, parts in outputs.items()})
+    print(f'Wrote predictions for {len(X)} windows to {args.output}')
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='python -m utils.cli', description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    sub = subparsers.add_parser('preprocess', help='run the feature pipeline on a raw Statcast csv')
+    sub.add_argument('raw_csv')
+    sub.add_argument('output', help='.npz file for the feature frame (read back with utils.cache.arrays_to_frame)')
+    sub.add_argument('--cache-dir', help='optional FeatureCache directory')
+    sub.add_argument('--fixed-vocabulary', action='store_true', help='encode against the values scanned from the file')
+    sub.set_defaults(function=preprocess)
+
+    sub = subparsers.add_parser('sequence', help='write memory-mapped sequence tensors for a raw Statcast csv')
+    sub.add_argument('raw_csv')
+    sub.add_argument('out_dir')
+    sub.add_argument('--max-length', type=int, default=6)
+    sub.add_argument('--dtype', default='int8')
+    sub.set_defaults(function=sequence)
+
+    sub = subparsers.add_parser('train', help='train a three-head ensemble on written sequences')
+    sub.add_argument('sequences_dir')
+    sub.add_argument('output', help='.keras file for the trained model')
+    sub.add_argument('--cell', choices=['lstm', 'gru'], default='lstm')
+    sub.add_argument('--epochs', type=int, default=100)
+    sub.add_argument('--batch-size', type=int, default=64)
+    sub.add_argument('--patience', type=int, default=5)
+    sub.add_argument('--threads', type=int, help='TensorFlow thread budget')
+    sub.add_argument('--seed', type=int, default=42)
+    sub.add_argument('--verbose', type=int, default=0)
+    sub.set_defaults(function=train)
+
+    sub = subparsers.add_parser('predict', help='predict pitch type and location for saved windows')
+    sub.add_argument('model', help='.keras model, or .tflite model from utils.export (no tensorflow import)')
+    sub.add_argument('windows', help='.npy file of windows, e.g. X.npy written by the sequence subcommand')
+    sub.add_argument('output', help='.npz file for the pitch, vertical and horizontal probabilities')
+    sub.add_argument('--batch-size', type=int, default=1024)
+    sub.add_argument('--threads', type=int, help='interpreter threads')
+    sub.set_defaults(function=predict)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    args.function(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
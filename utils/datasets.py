@@ -0,0 +1,108 @@
+import numpy as np
+import tensorflow as tf
+
+
+class SequenceBatches(tf.keras.utils.PyDataset):
+    """
+    Keras dataset that reads batches lazily from (memory-mapped) sequence tensors.
+    Only the rows of the current batch are read and cast to float32, so a split is an index array rather than a copy.
+    Args
+        X, y_pitch, y_vertical, y_horizontal: arrays or memmaps from utils.sequence_store.open_sequences.
+        indices: rows of the split to iterate over. Defaults to every row.
+        batch_size: number of samples per batch.
+        shuffle: reshuffle the indices at the end of every epoch.
+        seed: seed of the shuffling.
+    """
+    def __init__(self, X, y_pitch, y_vertical, y_horizontal, indices=None, batch_size=64, shuffle=False, seed=None,
+                 **kwargs) -> None:
+        super(SequenceBatches, self).__init__(**kwargs)
+        self.X = X
+        self.y_pitch = y_pitch
+        self.y_vertical = y_vertical
+        self.y_horizontal = y_horizontal
+        self.indices = np.arange(len(X)) if indices is None else np.asarray(indices)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.rng = np.random.default_rng(seed)
+        if self.shuffle:
+            self.rng.shuffle(self.indices)
+
+    def __len__(self):
+        return (len(self.indices) + self.batch_size - 1) // self.batch_size
+
+    def __getitem__(self, index):
+        # Sorting the batch keeps reads from the memory map close together
+        return self.read(np.sort(self.indices[index * self.batch_size: (index + 1) * self.batch_size]))
+
+    def read(self, batch):
+        # Inputs and labels of the given sorted rows
+        return (self.X[batch].astype(np.float32),
+                {'pitch_output': self.y_pitch[batch].astype(np.float32),
+                 'vertical_output': self.y_vertical[batch].astype(np.float32),
+                 'horizontal_output': self.y_horizontal[batch].astype(np.float32)})
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            self.rng.shuffle(self.indices)
+
+
+class WindowBatches(SequenceBatches):
+    """
+    Keras dataset over utils.sequencer.CompactSequences: the windows of a batch are gathered from the per-pitch
+    matrices when the batch is requested, so the padded (samples, max_length, features) tensor never exists in memory.
+    Args
+        sequences: output of Sequencer.make_compact.
+        indices, batch_size, shuffle, seed: as in SequenceBatches.
+    """
+    def __init__(self, sequences, indices=None, batch_size=64, shuffle=False, seed=None, **kwargs) -> None:
+        super(WindowBatches, self).__init__(sequences.windows, None, None, None, indices=indices,
+                                            batch_size=batch_size, shuffle=shuffle, seed=seed, **kwargs)
+        self.sequences = sequences
+
+    def read(self, batch):
+        X, y_pitch, y_vertical, y_horizontal = self.sequences.gather(batch)
+        return (X.astype(np.float32),
+                {'pitch_output': y_pitch.astype(np.float32),
+                 'vertical_output': y_vertical.astype(np.float32),
+                 'horizontal_output': y_horizontal.astype(np.float32)})
+
+
+class BalancedBatches(tf.keras.utils.PyDataset):
+    """
+    Keras dataset whose batches are drawn by a utils.sampling.StratifiedSampler instead of in order.
+    Rare pitch types are oversampled by repeating their indices, so X is never copied or concatenated.
+    Args
+        batches: SequenceBatches or WindowBatches over the data; only its read method is used.
+        sampler: StratifiedSampler over the rows to train on (e.g. the training split).
+        sample_weight: None, 'importance' to undo the rebalancing in the loss (the sampler then only changes how often
+            rare strata are seen), or a per-sample weight array over all rows, e.g. stratum_weights for models trained
+            without the sampler.
+    Batches are (X, y) or (X, y, sample_weight) with the same weights for every output.
+    """
+    def __init__(self, batches, sampler, sample_weight=None, **kwargs) -> None:
+        super(BalancedBatches, self).__init__(**kwargs)
+        if isinstance(sample_weight, str) and sample_weight != 'importance':
+            raise ValueError(f"sample_weight must be None, 'importance' or an array, got {sample_weight!r}")
+        self.batches = batches
+        self.sampler = sampler
+        self.sample_weight = sample_weight
+        self.epoch = [self.sampler.next_batch() for _ in range(len(self.sampler))]
+
+    def __len__(self):
+        return len(self.sampler)
+
+    def __getitem__(self, index):
+        batch = self.epoch[index]
+        X, y = self.batches.read(batch)
+        if self.sample_weight is None:
+            return X, y
+        if isinstance(self.sample_weight, str):
+            weights = self.sampler.importance_weights(batch)
+        else:
+            weights = np.asarray(self.sample_weight[batch], dtype=np.float64)
+        weights = weights.astype(np.float32)
+        return X, y, {name: weights for name in y}
+
+    def on_epoch_end(self):
+        # Draw the next epoch; the sampler carries its state over, so rare strata keep rotating through their samples
+        self.epoch = [self.sampler.next_batch() for _ in range(len(self.sampler))]
@@ -0,0 +1,140 @@
+import hashlib
+import json
+import numpy as np
+import pandas as pd
+
+# Numeric features, stored as they are
+NUMERIC_FEATURES = ['pitch_number', 'on_3b', 'on_2b', 'on_1b', 'score_diff', 'balls', 'strikes', 'outs_when_up']
+
+# Categorical features and the vocabulary key each one is coded against
+CATEGORICAL_FEATURES = {'previous_zone': 'zone', 'previous_pitch': 'pitch_type', 'inning': 'inning'}
+
+# Values seen across MLB Statcast data. Values outside the vocabulary are coded as unknown.
+LEAGUE_VOCABULARY = {
+    'pitch_type': ['CH', 'CS', 'CU', 'EP', 'FA', 'FC', 'FF', 'FO', 'FS', 'IN', 'KC', 'KN', 'PO', 'SC', 'SI', 'SL',
+                   'ST', 'SV'],
+    'zone': [1.0, 2.0, 3.0, 4.0, 5.0, 6.0, 7.0, 8.0, 9.0, 11.0, 12.0, 13.0, 14.0],
+    'inning': list(range(1, 19)),
+}
+
+N_LOCATIONS = 3
+
+
+class FeatureEncoder:
+    """
+    Fixed-vocabulary encoder that replaces the per-file pd.get_dummies columns with int8 category codes.
+    A pitch becomes one int8 row: the numeric features followed by one code per categorical feature, where 0 means
+    missing or unknown and 1..K index the vocabulary. Labels become int8 class codes (-1 for a missing pitch type).
+    Because the vocabulary is fixed, every pitcher's file is encoded to the same columns and a model trained on one
+    file can be used on any other. One-hot vectors are only built per batch, with expand or in the model itself
+    (see utils.layers.encoded_inputs).
+    Args
+        vocabulary: dict with the 'pitch_type', 'zone' and 'inning' values, e.g. LEAGUE_VOCABULARY or the output of
+            utils.preprocessing.scan_categories.
+    """
+    def __init__(self, vocabulary=None) -> None:
+        vocabulary = vocabulary or LEAGUE_VOCABULARY
+        self.vocabulary = {key: list(values) for key, values in vocabulary.items()}
+        for key, values in self.vocabulary.items():
+            if len(values) > 126:
+                raise ValueError(f'{key} has {len(values)} values; at most 126 fit in int8 codes')
+
+    @classmethod
+    def from_categories(cls, categories_list):
+        # Union of several vocabularies, e.g. scan_categories over every pitcher of a league
+        vocabulary = {key: set() for key in LEAGUE_VOCABULARY}
+        for categories in categories_list:
+            for key in vocabulary:
+                vocabulary[key].update(categories[key])
+        return cls({key: sorted(values) for key, values in vocabulary.items()})
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.vocabulary, f, indent=2, default=lambda value: value.item())
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls(json.load(f))
+
+    def fingerprint(self):
+        # Short hash of the vocabulary; data encoded with encoders of different fingerprints is not compatible
+        text = json.dumps(self.vocabulary, sort_keys=True, default=lambda value: value.item())
+        return hashlib.sha1(text.encode()).hexdigest()[:16]
+
+    @property
+    def columns(self):
+        return NUMERIC_FEATURES + list(CATEGORICAL_FEATURES)
+
+    @property
+    def n_pitch_types(self):
+        return len(self.vocabulary['pitch_type'])
+
+    def cardinalities(self):
+        # Number of codes of every categorical feature, including the unknown code 0
+        return {col: len(self.vocabulary[key]) + 1 for col, key in CATEGORICAL_FEATURES.items()}
+
+    def _codes(self, values, key):
+        # Position in the vocabulary, or -1 for a missing or unknown value
+        return pd.Categorical(values, categories=self.vocabulary[key]).codes.astype(np.int8)
+
+    def transform(self, data):
+        """
+        Encode a frame from select_features followed by get_zones.
+        Returns
+            encoded: frame with plate_app_id, the int8 feature columns and the int8 label columns
+                pitch_type, vertical_location and horizontal_location. It can be passed to the Sequencer with
+                n_pitch_types=n_vertical_locs=n_horizontal_locs=1.
+        Raises ValueError when data has feature columns the encoder has no code for (e.g. derived_features), since
+        they would otherwise be dropped silently.
+        """
+        known = ['plate_app_id', 'pitch_type', 'vertical_location', 'horizontal_location'] + self.columns
+        unknown = [col for col in data.columns if col not in known]
+        if unknown:
+            raise ValueError(f'FeatureEncoder cannot encode the columns {unknown}; '
+                             f'use preprocess_data for extra features')
+        encoded = {'plate_app_id': data['plate_app_id'].to_numpy()}
+        for col in NUMERIC_FEATURES:
+            encoded[col] = data[col].to_numpy().astype(np.int8)
+        for col, key in CATEGORICAL_FEATURES.items():
+            # Shift by one so that 0 is the unknown code
+            encoded[col] = self._codes(data[col], key) + 1
+        encoded['pitch_type'] = self._codes(data['pitch_type'], 'pitch_type')
+        encoded['vertical_location'] = data['vertical_location'].to_numpy().astype(np.int8)
+        encoded['horizontal_location'] = data['horizontal_location'].to_numpy().astype(np.int8)
+        return pd.DataFrame(encoded, index=data.index)
+
+    def expand(self, X):
+        """
+        One-hot expand a batch of encoded windows into the layout pd.get_dummies would produce for this vocabulary:
+        numeric features, then previous_zone_*, previous_pitch_* and inning_* columns.
+        Args
+            X: (..., len(columns)) array of encoded features.
+        Returns
+            float32 array of shape (..., n_expanded_features). Zero padding stays all zeros.
+        """
+        X = np.asarray(X)
+        n_numeric = len(NUMERIC_FEATURES)
+        parts = [X[..., :n_numeric].astype(np.float32)]
+        for i, n_codes in enumerate(self.cardinalities().values()):
+            # Row 0 of the identity is dropped so the unknown code maps to all zeros
+            parts.append(np.eye(n_codes, dtype=np.float32)[X[..., n_numeric + i].astype(np.intp)][..., 1:])
+        return np.concatenate(parts, axis=-1)
+
+    def expanded_columns(self):
+        return (NUMERIC_FEATURES
+                + [f'previous_zone_{zone}' for zone in self.vocabulary['zone']]
+                + [f'previous_pitch_{pitch}' for pitch in self.vocabulary['pitch_type']]
+                + [f'inning_{inning}' for inning in self.vocabulary['inning']])
+
+
+def one_hot_labels(codes, depth):
+    """
+    One-hot expand label codes for a batch; a code of -1 (missing pitch type) gives an all-zero row, like
+    pd.get_dummies does for a missing value.
+    """
+    codes = np.asarray(codes).reshape(-1).astype(np.intp)
+    labels = np.zeros((len(codes), depth), dtype=np.float32)
+    valid = codes >= 0
+    labels[np.flatnonzero(valid), codes[valid]] = 1
+    return labels
@@ -0,0 +1,224 @@
+import logging
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from utils import instrumentation
+from utils.sampling import class_codes
+
+HEADS = ['pitch', 'vertical', 'horizontal']
+
+logger = logging.getLogger(__name__)
+
+
+def _softmax(logits):
+    logits = logits - logits.max(axis=1, keepdims=True)
+    exp = np.exp(logits)
+    return exp / exp.sum(axis=1, keepdims=True)
+
+
+class EnsembleCombiner:
+    """
+    Serves several three-head ensembles (e.g. the LSTM, GRU, attention LSTM and transformer families) as one model.
+    Every call casts the input batch once and hands the same array to all members, which run concurrently on a
+    thread pool with one batched call each (TensorFlow and TFLite release the GIL while they compute). The per-head
+    probabilities are combined by a weighted average or, after fit_stacking, by a per-head softmax regression over
+    the members' log probabilities.
+    The instance is a predict function, so it can be passed to utils.inference.PitchPredictor or
+    utils.evaluation.evaluate_model in place of a model.
+    Args
+        members: dict mapping a family name to a predict function windows -> [pitch, vertical, horizontal]
+            probabilities, e.g. utils.inference.keras_predict_fn(model) or a utils.lite.LitePredictor. from_paths
+            builds them from the saved models.
+        weights: optional dict mapping a member to a weight, or to a dict of per-head weights. Equal by default.
+        latency_budget: optional budget in milliseconds. Once every member has latency_window timings, members are
+            dropped, slowest first, until the slowest remaining member fits the budget.
+        latency_window: number of recent calls the latency percentiles are computed over.
+    """
+    def __init__(self, members, weights=None, latency_budget=None, latency_window=100) -> None:
+        self.members = dict(members)
+        self.active = list(self.members)
+        self.weights = {name: {head: 1.0 for head in HEADS} for name in self.members}
+        for name, weight in (weights or {}).items():
+            self.weights[name] = dict(weight) if isinstance(weight, dict) else {head: weight for head in HEADS}
+        self.stackers = None
+        self.latency_budget = latency_budget
+        self.latency_window = latency_window
+        self.latencies = {name: deque(maxlen=latency_window) for name in self.members}
+        self.pool = ThreadPoolExecutor(max_workers=len(self.members))
+
+    @classmethod
+    def from_paths(cls, paths, custom_objects=None, **kwargs):
+        """
+        Load every family's saved model once and serve them as one ensemble.
+        Args
+            paths: dict mapping a family name (e.g. 'lstm', 'gru', 'attention_lstm', 'transformer') to a saved .keras
+                model or to a .tflite model exported by utils.export.export_tflite.
+            custom_objects: optional dict of custom layers and functions, passed to load_model for every .keras
+                model. The notebooks' families only use built-in Keras layers (LSTM, GRU, Attention,
+                MultiHeadAttention, ...), so it is only needed for models with layers of their own.
+            kwargs: passed to the constructor, e.g. weights or latency_budget.
+        Returns
+            EnsembleCombiner over keras_predict_fn(model) or LitePredictor members.
+        """
+        members = {}
+        for name, path in paths.items():
+            if path.endswith('.tflite'):
+                from utils.lite import LitePredictor
+                members[name] = LitePredictor(path)
+            else:
+                import tensorflow as tf
+                from utils.inference import keras_predict_fn
+                # Serving never trains, so the optimizer state does not need to be restored
+                model = tf.keras.models.load_model(path, custom_objects=custom_objects, compile=False)
+                members[name] = keras_predict_fn(model)
+        return cls(members, **kwargs)
+
+    def _run_member(self, name, windows):
+        start = time.perf_counter()
+        outputs = [np.asarray(output) for output in self.members[name](windows)]
+        self.latencies[name].append(time.perf_counter() - start)
+        return outputs
+
+    def _predict(self, windows, names):
+        windows = np.asarray(windows, dtype=np.float32)
+        futures = {name: self.pool.submit(self._run_member, name, windows) for name in names}
+        return {name: future.result() for name, future in futures.items()}
+
+    def predict_members(self, windows):
+        # Outputs of every active member for the same batch, computed concurrently
+        outputs = self._predict(windows, self.active)
+        if self.latency_budget is not None:
+            self.enforce_budget()
+        return outputs
+
+    def combine(self, member_outputs):
+        # Combine the members' per-head probabilities into one [pitch, vertical, horizontal] list
+        names = list(member_outputs)
+        combined = []
+        for i, head in enumerate(HEADS):
+            if self.stackers is not None:
+                features = np.concatenate([np.log(np.clip(member_outputs[name][i], 1e-7, 1)) for name in names],
+                                          axis=1)
+                coef, intercept = self.stackers[head]
+                combined.append(_softmax(features @ coef + intercept))
+                continue
+            weights = np.array([self.weights[name][head] for name in names], dtype=np.float64)
+            if not np.isfinite(weights).all() or weights.sum() <= 0:
+                # No usable weights for this head, e.g. every member scored 0: average the members equally
+                weights = np.ones(len(names))
+            probs = np.stack([member_outputs[name][i] for name in names])
+            combined.append(np.tensordot(weights / weights.sum(), probs, axes=1))
+        return combined
+
+    def __call__(self, windows):
+        return self.combine(self.predict_members(windows))
+
+    def predict(self, windows):
+        return self(windows)
+
+    def _collect(self, X, indices, batch_size):
+        # Member outputs over a whole evaluation set, batch by batch
+        indices = np.arange(len(X)) if indices is None else np.sort(indices)
+        # The latency budget is not enforced here, so every batch has the same members
+        collected = {name: [[] for _ in HEADS] for name in self.active}
+        for start in range(0, len(indices), batch_size):
+            outputs = self._predict(X[indices[start: start + batch_size]], list(collected))
+            for name, heads in outputs.items():
+                for i, output in enumerate(heads):
+                    collected[name][i].append(output)
+        return indices, {name: [np.concatenate(parts) for parts in heads] for name, heads in collected.items()}
+
+    def fit_weights(self, X, y_pitch, y_vertical, y_horizontal, indices=None, batch_size=1024):
+        """
+        Weight every member per head by its accuracy on a validation set, so a family that is better at locations
+        than at pitch types counts more for the location heads. A head without valid labels, or on which every member
+        scores 0, keeps equal weights.
+        Returns
+            the per-member, per-head accuracies.
+        """
+        indices, outputs = self._collect(X, indices, batch_size)
+        accuracies = {name: {} for name in outputs}
+        for i, (head, y) in enumerate(zip(HEADS, [y_pitch, y_vertical, y_horizontal])):
+            codes = class_codes(y[indices])
+            valid = codes >= 0
+            for name in outputs:
+                accuracies[name][head] = (float((outputs[name][i][valid].argmax(axis=1) == codes[valid]).mean())
+                                          if valid.any() else float('nan'))
+            head_accuracies = np.array([accuracies[name][head] for name in outputs])
+            usable = np.isfinite(head_accuracies).all() and head_accuracies.sum() > 0
+            for name in outputs:
+                self.weights[name][head] = accuracies[name][head] if usable else 1.0
+        self.stackers = None
+        return accuracies
+
+    def fit_stacking(self, X, y_pitch, y_vertical, y_horizontal, indices=None, batch_size=1024, C=1.0):
+        """
+        Fit a multinomial logistic regression per head on the members' log probabilities over a validation set.
+        Only the coefficients are kept, so serving does not need scikit-learn. Later calls use the members that were
+        active while fitting; dropping a member afterwards requires fitting again.
+        """
+        from sklearn.linear_model import LogisticRegression
+
+        indices, outputs = self._collect(X, indices, batch_size)
+        names = list(outputs)
+        self.stackers = {}
+        for i, (head, y) in enumerate(zip(HEADS, [y_pitch, y_vertical, y_horizontal])):
+            codes = class_codes(y[indices])
+            valid = codes >= 0
+            features = np.concatenate([np.log(np.clip(outputs[name][i], 1e-7, 1)) for name in names], axis=1)
+            n_classes = outputs[names[0]][i].shape[1]
+            regression = LogisticRegression(C=C, max_iter=1000).fit(features[valid], codes[valid])
+            # Classes missing from the validation labels keep a very low score
+            coef = np.zeros((features.shape[1], n_classes))
+            intercept = np.full(n_classes, -1e3)
+            if len(regression.classes_) == 2:
+                # Binary problems store one coefficient row for the second class
+                coef[:, regression.classes_[1]] = regression.coef_[0]
+                intercept[regression.classes_] = [0.0, regression.intercept_[0]]
+            else:
+                coef[:, regression.classes_] = regression.coef_.T
+                intercept[regression.classes_] = regression.intercept_
+            self.stackers[head] = (coef, intercept)
+
+    def latency_report(self):
+        # Median and 99th percentile latency of every member over its recent calls, in milliseconds
+        report = {}
+        for name, latencies in self.latencies.items():
+            if latencies:
+                report[name] = {'p50_ms': float(np.percentile(latencies, 50) * 1000),
+                                'p99_ms': float(np.percentile(latencies, 99) * 1000),
+                                'calls': len(latencies),
+                                'active': name in self.active}
+        return report
+
+    def enforce_budget(self, budget=None):
+        """
+        Drop the slowest members until the slowest remaining one has a median latency within budget milliseconds.
+        Members run concurrently, so the slowest member sets the latency of the ensemble. The fastest member is
+        always kept.
+        Returns
+            the members dropped by this call.
+        """
+        budget = self.latency_budget if budget is None else budget
+        if any(len(self.latencies[name]) < self.latency_window for name in self.active):
+            return []
+        p50 = {name: np.median(self.latencies[name]) * 1000 for name in self.active}
+        dropped = []
+        for name in sorted(self.active, key=p50.get, reverse=True)[:-1]:
+            if p50[name] <= budget:
+                break
+            self.active.remove(name)
+            dropped.append(name)
+            instrumentation.count(f'ensemble.dropped.{name}')
+            logger.warning('Dropping %s from the ensemble: median latency %.2f ms over the %.2f ms budget.',
+                           name, p50[name], budget)
+        if dropped:
+            instrumentation.gauge('ensemble.active_members', len(self.active))
+        if dropped and self.stackers is not None:
+            logger.warning('The stacking regression was fitted with the dropped members; falling back to weighting.')
+            self.stackers = None
+        return dropped
+
+    def close(self):
+        self.pool.shutdown()
@@ -0,0 +1,236 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, wait
+import numpy as np
+import pandas as pd
+from utils.sampling import class_codes
+
+HEADS = ['pitch', 'vertical', 'horizontal']
+
+
+class HeadAccumulator:
+    """
+    Streaming metrics of one output head, updated batch by batch with np.bincount so the predictions never have to
+    be kept in memory.
+    Tracks the confusion matrix, top-k accuracy, log loss and a reliability table (confidence of the predicted class
+    in n_bins equal-width bins) for the expected calibration error.
+    Rows with an all-zero label (a missing pitch type) are skipped.
+    Args
+        n_classes: number of classes of the head.
+        top_k: k values of the top-k accuracies.
+        n_bins: number of confidence bins of the reliability table.
+    """
+    def __init__(self, n_classes, top_k=(2, 3), n_bins=10) -> None:
+        self.n_classes = n_classes
+        self.top_k = [k for k in top_k if k <= n_classes]
+        self.n_bins = n_bins
+        self.confusion = np.zeros((n_classes, n_classes), dtype=np.int64)
+        self.top_k_hits = {k: 0 for k in self.top_k}
+        self.log_loss_sum = 0.0
+        self.bin_counts = np.zeros(n_bins, dtype=np.int64)
+        self.bin_confidence = np.zeros(n_bins)
+        self.bin_correct = np.zeros(n_bins)
+
+    @property
+    def n_samples(self):
+        return int(self.confusion.sum())
+
+    def update(self, y_true, y_prob):
+        """
+        Args
+            y_true: (batch, n_classes) one-hot labels or (batch,) class codes (-1 for a missing label).
+            y_prob: (batch, n_classes) predicted probabilities.
+        """
+        y_prob = np.asarray(y_prob, dtype=np.float64)
+        true = class_codes(y_true)
+        valid = true >= 0
+        true, y_prob = true[valid], y_prob[valid]
+        pred = y_prob.argmax(axis=1)
+
+        self.confusion += np.bincount(true * self.n_classes + pred,
+                                      minlength=self.n_classes ** 2).reshape(self.n_classes, self.n_classes)
+        # Rank of the true class: the number of classes with a higher probability
+        true_prob = y_prob[np.arange(len(true)), true]
+        rank = (y_prob > true_prob[:, None]).sum(axis=1)
+        for k in self.top_k:
+            self.top_k_hits[k] += int((rank < k).sum())
+        self.log_loss_sum += float(-np.log(np.clip(true_prob, 1e-7, 1)).sum())
+
+        confidence = y_prob.max(axis=1)
+        bins = np.minimum((confidence * self.n_bins).astype(np.int64), self.n_bins - 1)
+        self.bin_counts += np.bincount(bins, minlength=self.n_bins)
+        self.bin_confidence += np.bincount(bins, weights=confidence, minlength=self.n_bins)
+        self.bin_correct += np.bincount(bins, weights=pred == true, minlength=self.n_bins)
+
+    def reliability(self):
+        # Mean confidence and accuracy of every bin (NaN for empty bins)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.bin_confidence / self.bin_counts, self.bin_correct / self.bin_counts
+
+    def result(self):
+        n = max(self.n_samples, 1)
+        gap = np.abs(self.bin_confidence - self.bin_correct).sum()
+        metrics = {'accuracy': np.trace(self.confusion) / n}
+        metrics.update({f'top_{k}_accuracy': hits / n for k, hits in self.top_k_hits.items()})
+        metrics['log_loss'] = self.log_loss_sum / n
+        metrics['ece'] = gap / n
+        return metrics
+
+
+def evaluate_model(model, X, y_pitch, y_vertical, y_horizontal, indices=None, batch_size=1024, top_k=(2, 3),
+                   n_bins=10):
+    """
+    Evaluate every head of an ensemble in one batched forward pass, replacing model.evaluate followed by
+    model.predict.
+    Args
+        model: keras model with the three outputs, or any function batch -> [pitch, vertical, horizontal]
+            probabilities (e.g. a StepEnsemble's predict_windows).
+        X, y_pitch, y_vertical, y_horizontal: arrays or memmaps; labels one-hot or class codes.
+        indices: optional rows to evaluate, e.g. the test split from utils.sequence_store.split_indices.
+        batch_size: samples per forward pass.
+    Returns
+        dict mapping 'pitch', 'vertical' and 'horizontal' to a HeadAccumulator.
+    """
+    predict = getattr(model, 'predict_on_batch', model)
+    indices = np.arange(len(X)) if indices is None else np.sort(indices)
+    labels = [y_pitch, y_vertical, y_horizontal]
+    accumulators = {}
+    for start in range(0, len(indices), batch_size):
+        batch = indices[start: start + batch_size]
+        outputs = predict(np.asarray(X[batch], dtype=np.float32))
+        for head, y, probs in zip(HEADS, labels, outputs):
+            probs = np.asarray(probs)
+            if head not in accumulators:
+                accumulators[head] = HeadAccumulator(probs.shape[1], top_k=top_k, n_bins=n_bins)
+            accumulators[head].update(y[batch], probs)
+    return accumulators
+
+
+def summarize(accumulators):
+    # One flat row in the naming of the notebooks' results csv files, e.g. Pitch_Test_Acc
+    row = {}
+    for head, accumulator in accumulators.items():
+        prefix = head.capitalize()
+        for metric, value in accumulator.result().items():
+            name = {'accuracy': 'Acc', 'log_loss': 'LogLoss', 'ece': 'ECE'}.get(metric)
+            if name is None:
+                name = f"Top{metric.split('_')[1]}_Acc"
+            row[f'{prefix}_Test_{name}'] = float(value)
+    return row
+
+
+def compare_models(models, X, y_pitch, y_vertical, y_horizontal, indices=None, batch_size=1024, **kwargs):
+    """
+    Evaluate several model variants (e.g. LSTM, GRU, attention LSTM and transformer ensembles) on the same data.
+    Args
+        models: dict mapping a model name to a model or predict function.
+        other arguments: as in evaluate_model.
+    Returns
+        results_df: one row per model with the summarize columns.
+        accumulators: dict mapping a model name to its evaluate_model output, e.g. for plotting.
+    """
+    accumulators = {name: evaluate_model(model, X, y_pitch, y_vertical, y_horizontal, indices=indices,
+                                         batch_size=batch_size, **kwargs)
+                    for name, model in models.items()}
+    results_df = pd.DataFrame([{'Model': name, **summarize(accumulator)}
+                               for name, accumulator in accumulators.items()])
+    return results_df, accumulators
+
+
+def plot_confusion_matrices(confusions, title, output_path, display_labels=None):
+    """
+    Save the confusion matrices of the three heads side by side, in the layout of the *_test notebooks.
+    Args
+        confusions: dict mapping a head name to its confusion matrix.
+        title: figure title, e.g. the pitcher's name.
+        output_path: png file to write.
+        display_labels: optional dict mapping a head name to its class labels.
+    """
+    # Imported here so the parent process never needs a display backend
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    from sklearn.metrics import ConfusionMatrixDisplay
+
+    display_labels = display_labels or {}
+    fig, axes = plt.subplots(1, len(confusions), figsize=(6 * len(confusions), 6))
+    fig.suptitle(title, fontsize=16)
+    for ax, (head, confusion) in zip(np.atleast_1d(axes), confusions.items()):
+        labels = display_labels.get(head, np.arange(confusion.shape[0]))
+        ConfusionMatrixDisplay(confusion_matrix=confusion, display_labels=labels).plot(cmap=plt.cm.Blues, ax=ax,
+                                                                                       colorbar=False)
+        ax.set_title(f'{head.capitalize()} Output')
+    os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+    fig.savefig(output_path)
+    plt.close(fig)
+    return output_path
+
+
+def plot_reliability(reliabilities, title, output_path):
+    """
+    Save reliability diagrams (accuracy against confidence) of the three heads.
+    Args
+        reliabilities: dict mapping a head name to the (confidence, accuracy) output of HeadAccumulator.reliability.
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    fig, axes = plt.subplots(1, len(reliabilities), figsize=(6 * len(reliabilities), 6))
+    fig.suptitle(title, fontsize=16)
+    for ax, (head, (confidence, accuracy)) in zip(np.atleast_1d(axes), reliabilities.items()):
+        ax.plot([0, 1], [0, 1], linestyle='--', color='grey')
+        ax.plot(confidence, accuracy, marker='o')
+        ax.set_title(f'{head.capitalize()} Output')
+        ax.set_xlabel('Confidence')
+        ax.set_ylabel('Accuracy')
+    os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+    fig.savefig(output_path)
+    plt.close(fig)
+    return output_path
+
+
+class FigurePool:
+    """
+    Renders figures in background processes so evaluating the next pitcher or model does not wait for matplotlib.
+    Only the small accumulated arrays are sent to the workers.
+    Usage:
+        with FigurePool() as figures:
+            for pitcher in pitchers:
+                accumulators = evaluate_model(...)
+                figures.confusion_matrices(accumulators, pitcher, f'results/{pitcher}_confusion_matrices.png')
+    Args
+        n_workers: number of rendering processes.
+        mp_context: multiprocessing context of the pool. Defaults to spawn, so the workers do not inherit the
+            tensorflow and matplotlib state of a notebook that already imported them.
+    """
+    def __init__(self, n_workers=None, mp_context=None) -> None:
+        self.pool = ProcessPoolExecutor(max_workers=n_workers,
+                                        mp_context=mp_context or multiprocessing.get_context('spawn'))
+        self.futures = []
+
+    def submit(self, function, *args, **kwargs):
+        future = self.pool.submit(function, *args, **kwargs)
+        self.futures.append(future)
+        return future
+
+    def confusion_matrices(self, accumulators, title, output_path, display_labels=None):
+        confusions = {head: accumulator.confusion for head, accumulator in accumulators.items()}
+        return self.submit(plot_confusion_matrices, confusions, title, output_path, display_labels)
+
+    def reliability(self, accumulators, title, output_path):
+        reliabilities = {head: accumulator.reliability() for head, accumulator in accumulators.items()}
+        return self.submit(plot_reliability, reliabilities, title, output_path)
+
+    def close(self):
+        # Wait for every figure and raise the first rendering error, if any
+        wait(self.futures)
+        self.pool.shutdown()
+        for future in self.futures:
+            future.result()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,197 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+from utils.evaluation import HEADS, evaluate_model
+from utils.lite import LitePredictor, metadata_path
+from utils.lazy import LazyModule
+
+tf = LazyModule('tensorflow')
+
+MODES = ['float32', 'float16', 'dynamic', 'int8']
+
+# Repository root, so the measuring processes can import utils
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Imports the runtime of a model kind and, when a model path is given, loads it and runs one call on the window
+RSS_RUNNER = ('import sys\n'
+              'import numpy as np\n'
+              'window = np.load(sys.argv[1])\n'
+              'if sys.argv[2] == "keras":\n'
+              '    import tensorflow as tf\n'
+              '    load_model = tf.keras.models.load_model\n'
+              '    load = lambda path: load_model(path, compile=False)\n'
+              'else:\n'
+              '    from utils.lite import LitePredictor, _load_interpreter\n'
+              '    _load_interpreter()\n'
+              '    load = LitePredictor\n'
+              'if len(sys.argv) > 3:\n'
+              '    load(sys.argv[3])(window)\n'
+              'print([line for line in open("/proc/self/status") if line.startswith("VmHWM")][0].split()[1])\n')
+
+
+def representative_dataset(X, n_samples=200, seed=0):
+    """
+    Calibration samples for int8 quantization, drawn at random from get_sequences output (e.g. the training split).
+    Returns
+        function returning a generator of single-window float32 inputs, as TFLiteConverter expects.
+    """
+    rng = np.random.default_rng(seed)
+    rows = np.sort(rng.choice(len(X), size=min(n_samples, len(X)), replace=False))
+
+    def generator():
+        for row in rows:
+            yield [np.asarray(X[row: row + 1], dtype=np.float32)]
+    return generator
+
+
+def _serving_function(model, input_shape):
+    # Wrap the model so the TFLite signature names every output after its Keras output layer
+    output_names = [f'{head}_output' for head in HEADS]
+    if sorted(model.output_names) != sorted(output_names):
+        raise ValueError(f'Expected outputs {output_names}, got {model.output_names}')
+
+    @tf.function(input_signature=[tf.TensorSpec([None] + list(input_shape), tf.float32, name='windows')])
+    def serve(windows):
+        return dict(zip(model.output_names, model(windows, training=False)))
+    return serve.get_concrete_function()
+
+
+def _output_order(model_path):
+    """
+    Position in interpreter.get_output_details() of every head's output, looked up by signature output name.
+    Raises ValueError when the names do not identify every head exactly once.
+    """
+    interpreter = tf.lite.Interpreter(model_path=model_path)
+    signatures = interpreter.get_signature_list()
+    if len(signatures) != 1:
+        raise ValueError(f'Expected a single signature in {model_path}, got {list(signatures)}')
+    named = interpreter.get_signature_runner(next(iter(signatures))).get_output_details()
+    positions = {detail['index']: i for i, detail in enumerate(interpreter.get_output_details())}
+    order = []
+    for head in HEADS:
+        name = f'{head}_output'
+        if name not in named or named[name]['index'] not in positions:
+            raise ValueError(f'Output {name} not found in the signature of {model_path}: {list(named)}')
+        order.append(positions[named[name]['index']])
+    if len(set(order)) != len(order):
+        raise ValueError(f'Outputs of {model_path} map to the same tensor: {order}')
+    return order
+
+
+def export_tflite(model, model_path, X, mode='int8', n_samples=200):
+    """
+    Convert a three-head ensemble to TFLite.
+    Args
+        model: trained Keras model.
+        model_path: output .tflite file. The output order and input shape are saved next to it in <model_path>.json.
+        X: sequences to draw the representative dataset from, e.g. the training split of get_sequences.
+        mode: 'float32' (no quantization), 'float16' (float16 weights), 'dynamic' (int8 weights, float activations)
+            or 'int8' (int8 weights and activations calibrated on X; inputs and outputs stay float32 so the model is
+            a drop-in replacement).
+        n_samples: number of calibration samples for 'int8'.
+    Returns
+        model_path
+    """
+    if mode not in MODES:
+        raise ValueError(f'mode must be one of {MODES}, got {mode!r}')
+    converter = tf.lite.TFLiteConverter.from_concrete_functions([_serving_function(model, X.shape[1:])], model)
+    if mode != 'float32':
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if mode == 'float16':
+        converter.target_spec.supported_types = [tf.float16]
+    elif mode == 'int8':
+        converter.representative_dataset = representative_dataset(X, n_samples)
+    os.makedirs(os.path.dirname(model_path) or '.', exist_ok=True)
+    with open(model_path, 'wb') as f:
+        f.write(converter.convert())
+
+    metadata = {'mode': mode,
+                'input_shape': list(X.shape[1:]),
+                'output_names': [f'{head}_output' for head in HEADS],
+                'output_order': _output_order(model_path)}
+    with open(metadata_path(model_path), 'w') as f:
+        json.dump(metadata, f, indent=2)
+    return model_path
+
+
+def _latency(predict_fn, X, n_calls=200):
+    # Median single-window latency in milliseconds
+    latencies = []
+    for i in range(min(n_calls, len(X))):
+        window = np.asarray(X[i: i + 1], dtype=np.float32)
+        start = time.perf_counter()
+        predict_fn(window)
+        latencies.append(time.perf_counter() - start)
+    return float(np.median(latencies) * 1000)
+
+
+def _peak_rss_mb(kind, window_path, model_path=None):
+    # Peak resident memory in MB of a fresh process running RSS_RUNNER
+    args = [window_path, kind] + ([model_path] if model_path else [])
+    result = subprocess.run([sys.executable, '-c', RSS_RUNNER, *args], cwd=ROOT, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f'Measuring the memory of {model_path or kind} failed:\n{result.stderr}')
+    # VmHWM (in kilobytes) is reset by exec, unlike ru_maxrss, which keeps the peak of the forked parent
+    return int(result.stdout.strip().splitlines()[-1]) / 1024
+
+
+def _resident_memory(kind, model_path, window_path):
+    """
+    Peak RSS of loading a model and running one call, in a fresh process so earlier work in this one does not count.
+    Returns
+        peak_mb: peak RSS of the whole process, interpreter and imports included.
+        model_mb: peak_mb minus the peak of a process that only imports the same runtime.
+    """
+    peak_mb = _peak_rss_mb(kind, window_path, os.path.abspath(model_path))
+    return peak_mb, peak_mb - _peak_rss_mb(kind, window_path)
+
+
+def compare_quantized(model, model_paths, X, y_pitch, y_vertical, y_horizontal, indices=None, n_calls=200):
+    """
+    Report what quantization costs and saves against the float Keras model.
+    Args
+        model: trained Keras model.
+        model_paths: dict mapping a label (e.g. 'int8') to an exported .tflite file.
+        X, y_pitch, y_vertical, y_horizontal: evaluation data, e.g. the test split of get_sequences.
+        indices: optional rows to evaluate.
+        n_calls: number of single-window calls to time.
+    Returns
+        results_df: one row per exported model and head with the accuracy, its delta against the float model, the
+            median single-window latency, the size of the model file on disk (Disk_MB) and the resident memory.
+            Peak_RSS_MB is the peak RSS of a fresh process that loads the model and runs one window through it;
+            Model_RSS_MB is that minus the peak of a process that only imports the same runtime (tensorflow for the
+            Keras model, the TFLite interpreter otherwise), i.e. what the model, its activations and buffers add.
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        keras_path = os.path.join(tmp_dir, 'model.keras')
+        model.save(keras_path)
+        keras_mb = os.path.getsize(keras_path) / 2 ** 20
+        window_path = os.path.join(tmp_dir, 'window.npy')
+        np.save(window_path, np.asarray(X[:1], dtype=np.float32))
+        memory = {'keras': _resident_memory('keras', keras_path, window_path)}
+        for label, model_path in model_paths.items():
+            memory[label] = _resident_memory('tflite', model_path, window_path)
+
+    def keras_predict(windows):
+        return [np.asarray(output) for output in model(windows, training=False)]
+
+    reference = evaluate_model(keras_predict, X, y_pitch, y_vertical, y_horizontal, indices=indices)
+    rows = [{'Model': 'keras', 'Head': head, 'Accuracy': reference[head].result()['accuracy'], 'Delta': 0.0,
+             'Latency_ms': _latency(keras_predict, X, n_calls), 'Disk_MB': keras_mb, 'Peak_RSS_MB': memory['keras'][0],
+             'Model_RSS_MB': memory['keras'][1]} for head in HEADS]
+    for label, model_path in model_paths.items():
+        predictor = LitePredictor(model_path)
+        accumulators = evaluate_model(predictor, X, y_pitch, y_vertical, y_horizontal, indices=indices)
+        latency = _latency(predictor, X, n_calls)
+        for head in HEADS:
+            accuracy = accumulators[head].result()['accuracy']
+            rows.append({'Model': label, 'Head': head, 'Accuracy': accuracy,
+                         'Delta': accuracy - reference[head].result()['accuracy'], 'Latency_ms': latency,
+                         'Disk_MB': os.path.getsize(model_path) / 2 ** 20, 'Peak_RSS_MB': memory[label][0],
+                         'Model_RSS_MB': memory[label][1]})
+    return pd.DataFrame(rows)
@@ -0,0 +1,188 @@
+import json
+import os
+import numpy as np
+import pandas as pd
+from utils import instrumentation, preprocessing
+from utils.cache import arrays_to_frame, frame_to_arrays
+from utils.instrumentation import timed
+from utils.sequencer import check_range
+
+DEDUP_COLUMNS = ['plate_app_id', 'pitch_number']
+
+
+class IncrementalStore:
+    """
+    Per-pitcher feature and sequence store that grows one partition per update instead of being rebuilt.
+    Every call to append reads a Statcast export (a daily download or the full history), keeps only the games whose
+    game_pk is not stored yet, drops duplicate (plate_app_id, pitch_number) rows, runs the feature pipeline on those
+    rows only and sequences only their at-bats. The new features and windows are saved as a new partition, so the
+    cost of an update scales with the new pitches, not with the career.
+    All partitions are encoded against the vocabulary fixed when the store is created, so their columns line up and
+    a model trained on the store keeps its input shape across updates. Values outside the vocabulary map to all-zero
+    dummy columns.
+    Layout of store_dir: manifest.json plus <partition>_features.npz and <partition>_sequences.npz per partition.
+    Args
+        store_dir: directory of the store.
+        categories: vocabulary (see utils.preprocessing.scan_categories). Required when the store is created,
+            read from the manifest afterwards.
+        max_length: number of timesteps per sequence.
+        derived_features: optional extra features, see utils.preprocessing.engineer_features.
+    """
+    def __init__(self, store_dir, categories=None, max_length=6, derived_features=None) -> None:
+        self.store_dir = store_dir
+        self.derived_features = derived_features
+        self.manifest_path = os.path.join(store_dir, 'manifest.json')
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path) as f:
+                self.manifest = json.load(f)
+        else:
+            if categories is None:
+                raise ValueError('categories are required to create a new store')
+            self.manifest = {'categories': categories, 'max_length': max_length, 'partitions': []}
+        self.categories = self.manifest['categories']
+        self.max_length = self.manifest['max_length']
+
+    @property
+    def partitions(self):
+        return [partition['name'] for partition in self.manifest['partitions']]
+
+    def known_game_pks(self):
+        return {game_pk for partition in self.manifest['partitions'] for game_pk in partition['game_pks']}
+
+    def _path(self, partition, kind):
+        return os.path.join(self.store_dir, f'{partition}_{kind}.npz')
+
+    def _save_manifest(self):
+        # Partition files are written before the manifest, so a crash never references a missing partition
+        with open(f'{self.manifest_path}.tmp', 'w') as f:
+            json.dump(self.manifest, f, indent=2, default=lambda value: value.item())
+        os.replace(f'{self.manifest_path}.tmp', self.manifest_path)
+
+    def _read_new(self, file_path):
+        data = pd.read_csv(file_path, usecols=list(preprocessing.RAW_DTYPES), dtype=preprocessing.RAW_DTYPES)
+        data = preprocessing.filter_regular_season(data)
+        data = data[~data['game_pk'].isin(self.known_game_pks())]
+        data = preprocessing.add_plate_app_id(data.copy())
+        n_rows = len(data)
+        data = data.drop_duplicates(subset=DEDUP_COLUMNS, keep='last')
+        instrumentation.count('incremental.duplicates_dropped', n_rows - len(data))
+        return data
+
+    @timed('incremental.append')
+    def append(self, file_path):
+        """
+        Add the games of a raw Statcast export that are not in the store yet.
+        Returns
+            (X, y_pitch, y_vertical, y_horizontal) windows of the new at-bats, or None when there was nothing new.
+        """
+        data = self._read_new(file_path)
+        if data.empty:
+            return None
+        unknown = set(data['pitch_type'].dropna().unique()) - set(self.categories['pitch_type'])
+        if unknown:
+            print(f'Pitch types outside the store vocabulary are encoded as all zeros: {sorted(unknown)}')
+
+        features = preprocessing.preprocess_frame(data, self.categories, self.derived_features)
+        X, y_pitch, y_vertical, y_horizontal = preprocessing.frame_sequencer(features, self.categories,
+                                                                             self.max_length).make_sequences()
+        # Partitions store int8 features, like write_sequences; values that do not fit must not wrap silently
+        check_range(X, np.int8)
+        sequences = (X.astype(np.int8), y_pitch.astype(np.uint8), y_vertical.astype(np.uint8),
+                     y_horizontal.astype(np.uint8))
+
+        os.makedirs(self.store_dir, exist_ok=True)
+        name = f'part_{len(self.manifest["partitions"]):04d}'
+        np.savez(self._path(name, 'features'), **frame_to_arrays(features))
+        np.savez(self._path(name, 'sequences'), X=sequences[0], y_pitch=sequences[1], y_vertical=sequences[2],
+                 y_horizontal=sequences[3])
+        self.manifest['partitions'].append({'name': name,
+                                            'game_pks': sorted(int(game_pk) for game_pk in data['game_pk'].unique()),
+                                            'n_pitches': len(features),
+                                            'n_windows': len(X)})
+        self._save_manifest()
+        instrumentation.count('incremental.pitches', len(features))
+        instrumentation.count('incremental.sequences', len(X))
+        return sequences
+
+    def load_features(self, partitions=None):
+        # Feature frame of the given partitions (all by default), in partition order
+        frames = []
+        for partition in partitions or self.partitions:
+            with np.load(self._path(partition, 'features'), allow_pickle=False) as arrays:
+                frames.append(arrays_to_frame({name: arrays[name] for name in arrays.files}))
+        return pd.concat(frames)
+
+    def load_sequences(self, partitions=None):
+        # Windows of the given partitions (all by default) as X, y_pitch, y_vertical, y_horizontal
+        parts = []
+        for partition in partitions or self.partitions:
+            with np.load(self._path(partition, 'sequences')) as arrays:
+                parts.append([arrays[name] for name in ['X', 'y_pitch', 'y_vertical', 'y_horizontal']])
+        return tuple(np.concatenate(arrays) for arrays in zip(*parts))
+
+    def replay_sample(self, n_samples, exclude=(), seed=None):
+        """
+        Draw historical windows uniformly across the partitions not in exclude, without loading the partitions
+        whose windows are not drawn.
+        """
+        rng = np.random.default_rng(seed)
+        partitions = [partition for partition in self.manifest['partitions'] if partition['name'] not in exclude]
+        sizes = np.array([partition['n_windows'] for partition in partitions])
+        if not sizes.sum() or not n_samples:
+            return None
+        rows = rng.choice(sizes.sum(), size=min(n_samples, sizes.sum()), replace=False)
+        which = np.searchsorted(np.cumsum(sizes), rows, side='right')
+        offsets = rows - (np.cumsum(sizes) - sizes)[which]
+        parts = []
+        for i in np.unique(which):
+            with np.load(self._path(partitions[i]['name'], 'sequences')) as arrays:
+                take = np.sort(offsets[which == i])
+                parts.append([arrays[name][take] for name in ['X', 'y_pitch', 'y_vertical', 'y_horizontal']])
+        return tuple(np.concatenate(arrays) for arrays in zip(*parts))
+
+
+def fine_tune(model, store, new_sequences, replay_ratio=1.0, epochs=5, batch_size=64, learning_rate=1e-4,
+              val_size=0.2, callbacks=None, seed=None):
+    """
+    Warm-start the existing ensemble on the new windows mixed with replayed historical windows, instead of
+    retraining from random weights.
+    Args
+        model: the trained three-head model, e.g. loaded with tf.keras.models.load_model.
+        store: the IncrementalStore the new windows were appended to.
+        new_sequences: output of store.append.
+        replay_ratio: number of historical windows per new window, to keep the model from forgetting.
+        epochs, batch_size, callbacks: passed to fit.
+        learning_rate: learning rate of the fine-tuning, lower than the one the model was trained with.
+        val_size: share of the mixed windows held out for validation.
+        seed: seed of the replay sampling and the shuffling.
+    Returns
+        history
+    """
+    import tensorflow as tf
+
+    newest = store.partitions[-1:]
+    replay = store.replay_sample(int(len(new_sequences[0]) * replay_ratio), exclude=newest, seed=seed)
+    arrays = new_sequences if replay is None else [np.concatenate(pair) for pair in zip(new_sequences, replay)]
+    X, y_pitch, y_vertical, y_horizontal = [array.astype(np.float32) for array in arrays]
+
+    rng = np.random.default_rng(seed)
+    order = rng.permutation(len(X))
+    n_val = int(len(X) * val_size)
+    val_idx, train_idx = order[:n_val], order[n_val:]
+
+    model.compile(optimizer=tf.keras.optimizers.Adam(learning_rate=learning_rate),
+                  loss={'pitch_output': 'categorical_crossentropy',
+                        'vertical_output': 'categorical_crossentropy',
+                        'horizontal_output': 'categorical_crossentropy'},
+                  metrics=['accuracy', 'accuracy', 'accuracy'])
+    return model.fit(X[train_idx],
+                     {'pitch_output': y_pitch[train_idx],
+                      'vertical_output': y_vertical[train_idx],
+                      'horizontal_output': y_horizontal[train_idx]},
+                     epochs=epochs, batch_size=batch_size,
+                     validation_data=(X[val_idx],
+                                      {'pitch_output': y_pitch[val_idx],
+                                       'vertical_output': y_vertical[val_idx],
+                                       'horizontal_output': y_horizontal[val_idx]}) if n_val else None,
+                     callbacks=callbacks,
+                     verbose=0)
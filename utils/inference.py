@@ -0,0 +1,279 @@
+import asyncio
+import json
+from collections import OrderedDict, deque
+import numpy as np
+
+# Numeric features in the order preprocess_data emits them, before the one-hot columns
+BASE_FEATURES = ['pitch_number', 'on_3b', 'on_2b', 'on_1b', 'score_diff', 'balls', 'strikes', 'outs_when_up']
+
+
+def _occupied(runner):
+    # Statcast stores the runner's id on an occupied base and NaN on an empty one
+    return runner is not None and runner == runner and runner != 0
+
+
+class FeatureLayout:
+    """
+    Maps the pre-pitch game state to the feature vector the models were trained on, without going through pandas.
+    Args
+        columns: feature column names in model order, i.e. the Sequencer frame without plate_app_id and the labels.
+    """
+    def __init__(self, columns) -> None:
+        self.columns = list(columns)
+        self.index = {col: i for i, col in enumerate(self.columns)}
+        self.base_index = np.array([self.index[col] for col in BASE_FEATURES])
+
+    @classmethod
+    def from_categories(cls, categories):
+        # Same columns preprocess_data produces when given a fixed vocabulary
+        columns = (BASE_FEATURES
+                   + [f'previous_zone_{zone}' for zone in categories['zone']]
+                   + [f'previous_pitch_{pitch}' for pitch in categories['pitch_type']]
+                   + [f'inning_{inning}' for inning in categories['inning']])
+        return cls(columns)
+
+    @classmethod
+    def from_sequencer(cls, seq):
+        n_labels = seq.n_pitch_types + seq.n_vertical_locs + seq.n_horizontal_locs
+        return cls(seq.data.columns[1: -n_labels])
+
+    def vector(self, pitch_number, inning, on_3b, on_2b, on_1b, score_diff, balls, strikes, outs_when_up,
+               previous_pitch=None, previous_zone=None):
+        vector = np.zeros(len(self.columns), dtype=np.float32)
+        vector[self.base_index] = [pitch_number, _occupied(on_3b), _occupied(on_2b), _occupied(on_1b), score_diff,
+                                   balls, strikes, outs_when_up]
+        # Categories the model never saw stay all zeros, like an unseen value in pd.get_dummies
+        for col in [f'inning_{int(inning)}',
+                    None if previous_pitch is None else f'previous_pitch_{previous_pitch}',
+                    None if previous_zone is None else f'previous_zone_{float(previous_zone)}']:
+            if col in self.index:
+                vector[self.index[col]] = 1
+        return vector
+
+
+class AtBatState:
+    """
+    Incremental state of one plate appearance.
+    Holds the rolling window of the last max_length feature vectors plus the previous pitch and zone, so each new
+    pitch costs one feature vector instead of a rerun of the feature pipeline and the Sequencer.
+    """
+    def __init__(self, layout, max_length) -> None:
+        self.layout = layout
+        self.max_length = max_length
+        self.window = deque(maxlen=max_length)
+        self.pending = None
+        self.pitch_number = 0
+        self.previous_pitch = None
+        self.previous_zone = None
+
+    def next_vector(self, event):
+        """
+        Build the feature vector of the upcoming pitch and hold it as pending until record is called.
+        Args
+            event: dict with inning, inning_topbot, home_score, away_score, balls, strikes, outs_when_up and
+                on_1b/on_2b/on_3b (the runner's id, or null/0 for an empty base).
+        """
+        if event['inning_topbot'] == 'Top':
+            score_diff = event['home_score'] - event['away_score']
+        else:
+            score_diff = event['away_score'] - event['home_score']
+        self.pending = self.layout.vector(self.pitch_number + 1, event['inning'],
+                                          event.get('on_3b'), event.get('on_2b'), event.get('on_1b'), score_diff,
+                                          event['balls'], event['strikes'], event['outs_when_up'],
+                                          self.previous_pitch, self.previous_zone)
+        return self.pending
+
+    def next_window(self, event):
+        """
+        Build the model input for the upcoming pitch.
+        Args
+            event: see next_vector.
+        Returns
+            (max_length, n_features) array. Real timesteps come first followed by zero padding, as in training.
+        """
+        self.next_vector(event)
+        window = np.zeros((self.max_length, len(self.layout.columns)), dtype=np.float32)
+        steps = list(self.window)[-(self.max_length - 1):] if self.max_length > 1 else []
+        for i, vector in enumerate(steps + [self.pending]):
+            window[i] = vector
+        return window
+
+    def record(self, pitch_type, zone):
+        # Commit the pitch that was just thrown so it becomes history for the next one
+        if self.pending is None:
+            raise ValueError('record called before next_window for this plate appearance')
+        self.window.append(self.pending)
+        self.pending = None
+        self.pitch_number += 1
+        self.previous_pitch = pitch_type
+        self.previous_zone = zone
+
+
+class PitchPredictor:
+    """
+    Next-pitch predictor with per plate appearance state and micro-batching.
+    Concurrent predict calls that arrive within max_delay of each other are stacked into a single model call.
+    Args
+        predict_fn: function mapping a (batch, max_length, n_features) float32 array to the
+            [pitch, vertical, horizontal] probability arrays, e.g. keras_predict_fn(model).
+        layout: FeatureLayout of the model inputs.
+        pitch_types: names of the pitch type outputs, in model order.
+        max_length: number of timesteps of the model input.
+        max_batch_size: largest number of requests per model call.
+        max_delay: seconds to wait for more requests before running a partial batch.
+        max_states: number of plate appearances kept in memory; the least recently used ones are dropped.
+    """
+    def __init__(self, predict_fn, layout, pitch_types, max_length=6, max_batch_size=64, max_delay=0.002,
+                 max_states=10000) -> None:
+        self.predict_fn = predict_fn
+        self.layout = layout
+        self.pitch_types = list(pitch_types)
+        self.max_length = max_length
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.max_states = max_states
+        self.states = OrderedDict()
+        self._queue = None
+        self._worker = None
+
+    def state(self, plate_app_id):
+        state = self.states.get(plate_app_id)
+        if state is None:
+            state = self.states[plate_app_id] = AtBatState(self.layout, self.max_length)
+            if len(self.states) > self.max_states:
+                self.states.popitem(last=False)
+        else:
+            self.states.move_to_end(plate_app_id)
+        return state
+
+    def record(self, plate_app_id, pitch_type, zone):
+        self.state(plate_app_id).record(pitch_type, zone)
+
+    def end(self, plate_app_id):
+        self.states.pop(plate_app_id, None)
+
+    def _format(self, pitch, vertical, horizontal):
+        return {'pitch': dict(zip(self.pitch_types, pitch.tolist())),
+                'vertical': vertical.tolist(),
+                'horizontal': horizontal.tolist()}
+
+    def predict_now(self, plate_app_id, event):
+        # Synchronous single-request path, without batching
+        window = self.state(plate_app_id).next_window(event)
+        pitch, vertical, horizontal = self.predict_fn(window[None])
+        return self._format(pitch[0], vertical[0], horizontal[0])
+
+    async def predict(self, plate_app_id, event):
+        if self._worker is None:
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._run_batches())
+        window = self.state(plate_app_id).next_window(event)
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((window, future))
+        return await future
+
+    async def _run_batches(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_delay
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            # Callers that were cancelled (disconnect, timeout) while waiting no longer need a prediction
+            batch = [(window, future) for window, future in batch if not future.done()]
+            if not batch:
+                continue
+            windows = np.stack([window for window, _ in batch])
+            try:
+                # Run the model off the event loop so new requests keep queueing during the call
+                pitch, vertical, horizontal = await loop.run_in_executor(None, self.predict_fn, windows)
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for i, (_, future) in enumerate(batch):
+                # A future can also be cancelled during the model call
+                if not future.done():
+                    future.set_result(self._format(pitch[i], vertical[i], horizontal[i]))
+
+
+def keras_predict_fn(model):
+    # Calling the model directly avoids the per-call overhead of model.predict
+    def predict_fn(windows):
+        return [np.asarray(output) for output in model(windows, training=False)]
+    return predict_fn
+
+
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 500: 'Internal Server Error'}
+
+
+async def _respond(writer, status, response):
+    data = json.dumps(response).encode()
+    writer.write(f'HTTP/1.1 {status} {REASONS[status]}\r\nContent-Type: application/json\r\n'
+                 f'Content-Length: {len(data)}\r\n\r\n'.encode() + data)
+    await writer.drain()
+
+
+async def _handle(predictor, reader, writer):
+    # Minimal HTTP/1.1 keep-alive handler for JSON POST requests
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                break
+            try:
+                method, path, _ = request_line.decode().split(' ', 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, value = line.decode().split(':', 1)
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+            except ValueError as e:
+                # The rest of the stream cannot be parsed either, so answer and close the connection
+                await _respond(writer, 400, {'error': f'malformed request: {e}'})
+                break
+            status, response = 200, {}
+            try:
+                payload = json.loads(body) if body else {}
+                if method != 'POST':
+                    status, response = 405, {'error': 'method not allowed'}
+                elif path == '/predict':
+                    response = await predictor.predict(payload['plate_app_id'], payload)
+                elif path == '/record':
+                    predictor.record(payload['plate_app_id'], payload['pitch_type'], payload['zone'])
+                elif path == '/end':
+                    predictor.end(payload['plate_app_id'])
+                else:
+                    status, response = 404, {'error': 'not found'}
+            except (KeyError, ValueError) as e:
+                status, response = 400, {'error': str(e)}
+            except Exception as e:
+                status, response = 500, {'error': repr(e)}
+            await _respond(writer, status, response)
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(predictor, host='127.0.0.1', port=8080):
+    """
+    Serve a PitchPredictor over local HTTP.
+    Endpoints (all POST with a JSON body containing plate_app_id):
+        /predict: game state of the upcoming pitch (see AtBatState.next_window); returns the three heads' probabilities.
+        /record: pitch_type and zone of the pitch that was just thrown.
+        /end: drops the state of a finished plate appearance.
+    """
+    server = await asyncio.start_server(lambda r, w: _handle(predictor, r, w), host, port)
+    async with server:
+        await server.serve_forever()
@@ -0,0 +1,132 @@
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Instrumentation is off unless enable() is called; every hook checks this flag first and returns immediately
+_enabled = False
+_lock = threading.Lock()
+_counters = {}
+_gauges = {}
+_timers = {}
+
+
+def enable():
+    global _enabled
+    _enabled = True
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def is_enabled():
+    return _enabled
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _gauges.clear()
+        _timers.clear()
+
+
+def count(name, value=1):
+    # Add value to a monotonic counter
+    if not _enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def gauge(name, value):
+    # Record the latest value of a measurement, e.g. a metric at the end of an epoch
+    if not _enabled:
+        return
+    with _lock:
+        _gauges[name] = value
+
+
+def observe(name, seconds):
+    # Add one duration to a timer
+    if not _enabled:
+        return
+    with _lock:
+        timer = _timers.setdefault(name, {'count': 0, 'sum': 0.0, 'max': 0.0})
+        timer['count'] += 1
+        timer['sum'] += seconds
+        timer['max'] = max(timer['max'], seconds)
+
+
+@contextmanager
+def timer(name):
+    if not _enabled:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start)
+
+
+def timed(name):
+    """
+    Decorator that records every call of the function in the timer name.
+    When instrumentation is disabled the only overhead is one flag check per call.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return function(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                observe(name, time.perf_counter() - start)
+        return wrapper
+    return decorator
+
+
+def snapshot():
+    with _lock:
+        return {'counters': dict(_counters),
+                'gauges': dict(_gauges),
+                'timers': {name: dict(timer) for name, timer in _timers.items()}}
+
+
+def _prometheus_name(name, prefix):
+    return f"{prefix}_{''.join(c if c.isalnum() else '_' for c in name)}"
+
+
+def export_prometheus(path, prefix='pitch_prediction'):
+    """
+    Write the current values in the Prometheus text exposition format, e.g. for the node exporter textfile collector.
+    Timers are written as summaries (<name>_seconds_count and <name>_seconds_sum) plus a <name>_seconds_max gauge.
+    """
+    data = snapshot()
+    lines = []
+    for name, value in sorted(data['counters'].items()):
+        metric = _prometheus_name(name, prefix) + '_total'
+        lines += [f'# TYPE {metric} counter', f'{metric} {value}']
+    for name, value in sorted(data['gauges'].items()):
+        metric = _prometheus_name(name, prefix)
+        lines += [f'# TYPE {metric} gauge', f'{metric} {value}']
+    for name, timer in sorted(data['timers'].items()):
+        metric = _prometheus_name(name, prefix) + '_seconds'
+        lines += [f'# TYPE {metric} summary', f"{metric}_count {timer['count']}", f"{metric}_sum {timer['sum']}",
+                  f'# TYPE {metric}_max gauge', f"{metric}_max {timer['max']}"]
+    # Write to a temporary file first so a scraper never reads a half-written file
+    with open(f'{path}.tmp', 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.replace(f'{path}.tmp', path)
+
+
+def export_jsonl(path):
+    # Append the current values as one JSON line with a timestamp
+    with open(path, 'a') as f:
+        f.write(json.dumps({'time': time.time(), **snapshot()}) + '\n')
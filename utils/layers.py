@@ -0,0 +1,27 @@
+from utils.encoder import NUMERIC_FEATURES
+from utils.lazy import LazyModule
+
+tf = LazyModule('tensorflow')
+
+
+def encoded_inputs(encoder, max_length, embedding_dim=None, name='input'):
+    """
+    Model input for windows encoded by utils.encoder.FeatureEncoder.
+    The categorical codes are expanded inside the model, either to one-hot vectors (the same layout as the
+    pd.get_dummies features) or, with embedding_dim, to learned embeddings. Code 0 (unknown) maps to zeros in the
+    one-hot case.
+    Returns
+        input_layer: the tf.keras.Input to build the Model with.
+        x: the expanded (batch, max_length, n_features) tensor to pass to build_network in place of the input layer.
+    """
+    input_layer = tf.keras.Input(shape=(max_length, len(encoder.columns)), name=name)
+    n_numeric = len(NUMERIC_FEATURES)
+    parts = [input_layer[..., :n_numeric]]
+    for i, (col, n_codes) in enumerate(encoder.cardinalities().items()):
+        codes = tf.keras.ops.cast(input_layer[..., n_numeric + i], 'int32')
+        if embedding_dim:
+            parts.append(tf.keras.layers.Embedding(n_codes, embedding_dim, name=f'{name}_{col}_embedding')(codes))
+        else:
+            parts.append(tf.keras.ops.one_hot(codes, n_codes)[..., 1:])
+    x = tf.keras.layers.Concatenate(name=f'{name}_features')(parts)
+    return input_layer, x
@@ -0,0 +1,23 @@
+import importlib
+
+
+class LazyModule:
+    """
+    Stand-in for a heavy module (tensorflow, matplotlib.pyplot, pandas) that imports it on first attribute access.
+    Modules that only use the dependency inside functions can then be imported, e.g. by the CLI, without paying for it:
+        tf = LazyModule('tensorflow')
+    Modules that subclass its classes at import time (utils.datasets) import it directly; utils.callbacks creates its
+    subclasses on first use instead.
+    """
+    def __init__(self, name) -> None:
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+    def __repr__(self):
+        state = 'loaded' if self._module is not None else 'not loaded'
+        return f'<lazy module {self._name!r} ({state})>'
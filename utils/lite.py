@@ -0,0 +1,60 @@
+import json
+import numpy as np
+
+
+def _load_interpreter():
+    # Prefer the standalone TFLite runtimes, which load in a fraction of the time of the full tensorflow package
+    try:
+        from ai_edge_litert.interpreter import Interpreter
+    except ImportError:
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            from tensorflow.lite import Interpreter
+    return Interpreter
+
+
+def metadata_path(model_path):
+    return f'{model_path}.json'
+
+
+class LitePredictor:
+    """
+    Runs a three-head ensemble exported by utils.export.export_tflite with only numpy and a TFLite interpreter
+    imported, so prediction workers start without tensorflow or pandas.
+    The instance is a predict function: predictor(windows) returns the [pitch, vertical, horizontal] probabilities,
+    so it can be passed to utils.inference.PitchPredictor or utils.evaluation.evaluate_model in place of a model.
+    Args
+        model_path: .tflite file; the output order is read from the .json file written next to it.
+        num_threads: interpreter threads.
+    """
+    def __init__(self, model_path, num_threads=1) -> None:
+        with open(metadata_path(model_path)) as f:
+            self.metadata = json.load(f)
+        self.interpreter = _load_interpreter()(model_path=model_path, num_threads=num_threads)
+        self.interpreter.allocate_tensors()
+        self.input = self.interpreter.get_input_details()[0]
+        # Output tensors are not guaranteed to come out of the converter in the Keras order
+        outputs = self.interpreter.get_output_details()
+        self.outputs = [outputs[i]['index'] for i in self.metadata['output_order']]
+        self.batch_size = self.input['shape'][0]
+
+    @property
+    def output_names(self):
+        return self.metadata['output_names']
+
+    def _resize(self, batch_size):
+        self.interpreter.resize_tensor_input(self.input['index'], [batch_size] + self.metadata['input_shape'])
+        self.interpreter.allocate_tensors()
+        self.batch_size = batch_size
+
+    def __call__(self, windows):
+        windows = np.asarray(windows, dtype=np.float32)
+        if len(windows) != self.batch_size:
+            self._resize(len(windows))
+        self.interpreter.set_tensor(self.input['index'], windows)
+        self.interpreter.invoke()
+        return [self.interpreter.get_tensor(index).copy() for index in self.outputs]
+
+    def predict(self, windows):
+        return self(windows)
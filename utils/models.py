@@ -0,0 +1,69 @@
+from utils.lazy import LazyModule
+
+tf = LazyModule('tensorflow')
+
+# Recurrent layer of every model family that build_network supports
+CELLS = {'lstm': 'LSTM', 'gru': 'GRU'}
+
+# Per-head settings of the final ensembles in lstm_test.ipynb and gru_test.ipynb. l2 is the factor of the L2 kernel
+# regularizer (reg=tf.keras.regularizers.l2(...) in the notebooks); it is turned into a regularizer in build_model so
+# that importing this module does not load tensorflow.
+HEAD_PARAMS = {
+    'lstm': {
+        'pitch': {'num_hidden_layers': 1, 'num_hidden_units': 256, 'activation': 'tanh', 'recurrent_activation': 'elu',
+                  'l2': 0.001},
+        'vertical': {'num_hidden_layers': 3, 'num_hidden_units': 128, 'activation': 'relu',
+                     'recurrent_activation': 'tanh'},
+        'horizontal': {'num_hidden_layers': 3, 'num_hidden_units': 128, 'activation': 'relu',
+                       'recurrent_activation': 'tanh'},
+    },
+    'gru': {
+        'pitch': {'num_hidden_layers': 3, 'num_hidden_units': 128, 'activation': 'relu',
+                  'recurrent_activation': 'tanh'},
+        'vertical': {'num_hidden_layers': 1, 'num_hidden_units': 128, 'activation': 'relu',
+                     'recurrent_activation': 'sigmoid'},
+        'horizontal': {'num_hidden_layers': 1, 'num_hidden_units': 128, 'activation': 'relu',
+                       'recurrent_activation': 'sigmoid'},
+    },
+}
+
+
+def build_network(input_layer, num_targets, name='', num_hidden_units=128, num_hidden_layers=1, activation='tanh',
+                  recurrent_activation='sigmoid', reg=None, dropout=None, cell='lstm'):
+    """
+    One head of the ensemble, as built in the LSTMS_and_GRUS notebooks: stacked recurrent layers named
+    <name>_hidden_<i>, optional dropout and a softmax <name>_output layer.
+    """
+    layer = getattr(tf.keras.layers, CELLS[cell])
+    x = input_layer
+    for i in range(num_hidden_layers):
+        layer_name = f'{name}_hidden_{i + 1}'
+        # Only the last hidden layer returns a single vector
+        x = layer(units=num_hidden_units, activation=activation, recurrent_activation=recurrent_activation,
+                  return_sequences=i < num_hidden_layers - 1, kernel_regularizer=reg, name=layer_name)(x)
+        if dropout:
+            x = tf.keras.layers.Dropout(dropout, name=f'{layer_name}_dropout')(x)
+    return tf.keras.layers.Dense(units=num_targets, activation='softmax', name=f'{name}_output')(x)
+
+
+def build_model(input_shape, num_pitches, num_vertical_locs, num_horizontal_locs, cell='lstm', head_params=None):
+    """
+    Compiled three-head ensemble with the settings of the *_test notebook of the cell (HEAD_PARAMS[cell] by default).
+    head_params maps every head to build_network keyword arguments, where l2 may replace reg.
+    """
+    head_params = head_params or HEAD_PARAMS[cell]
+    input_layer = tf.keras.Input(shape=input_shape)
+    outputs = []
+    for name, num_targets in [('pitch', num_pitches), ('vertical', num_vertical_locs),
+                              ('horizontal', num_horizontal_locs)]:
+        params = dict(head_params[name])
+        if 'l2' in params:
+            params['reg'] = tf.keras.regularizers.l2(params.pop('l2'))
+        outputs.append(build_network(input_layer, num_targets=num_targets, name=name, cell=cell, **params))
+    ensemble_model = tf.keras.models.Model(inputs=input_layer, outputs=outputs)
+    ensemble_model.compile(optimizer='adam',
+                           loss={'pitch_output': 'categorical_crossentropy',
+                                 'vertical_output': 'categorical_crossentropy',
+                                 'horizontal_output': 'categorical_crossentropy'},
+                           metrics=['accuracy', 'accuracy', 'accuracy'])
+    return ensemble_model
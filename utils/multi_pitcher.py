@@ -0,0 +1,226 @@
+import json
+import os
+import shutil
+import numpy as np
+from utils import preprocessing
+from utils.encoder import FeatureEncoder, N_LOCATIONS
+from utils.layers import encoded_inputs
+from utils.sequence_store import split_indices
+from utils.lazy import LazyModule
+
+tf = LazyModule('tensorflow')
+
+SPLITS = {'train': 0, 'val': 1, 'test': 2}
+
+
+def pitcher_name(file_path):
+    return os.path.splitext(os.path.basename(file_path))[0]
+
+
+def _shard_meta(out_dir):
+    # Encoder fingerprint and max_length a shard was written with, or None for a shard without them
+    path = os.path.join(out_dir, 'meta.json')
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_shards(file_paths, encoder, shard_dir, max_length=6):
+    """
+    Encode every pitcher file with one shared FeatureEncoder and write one shard per pitcher.
+    A shard is shard_dir/<pitcher>/ with X.npy (int8 feature codes) and y.npy (int8 pitch type, vertical and horizontal
+    codes) and meta.json (encoder fingerprint and max_length). Shards that already exist are reused when they were
+    written with the same encoder vocabulary and max_length, so adding a pitcher only encodes the new file; any other
+    shard is encoded again.
+    Args
+        file_paths: raw Statcast csv files, one per pitcher.
+        encoder: FeatureEncoder whose vocabulary covers every pitcher, e.g. FeatureEncoder() or
+            FeatureEncoder.from_categories over scan_categories of every file.
+        shard_dir: output directory.
+        max_length: number of timesteps per sequence.
+    Returns
+        pitchers: pitcher names in pitcher id order. They are also saved to shard_dir/pitchers.json together with
+            the encoder (shard_dir/encoder.json).
+    """
+    os.makedirs(shard_dir, exist_ok=True)
+    meta = {'encoder': encoder.fingerprint(), 'max_length': max_length}
+    pitchers = []
+    for file_path in file_paths:
+        pitcher = pitcher_name(file_path)
+        out_dir = os.path.join(shard_dir, pitcher)
+        if _shard_meta(out_dir) != meta:
+            X, y_pitch, y_vertical, y_horizontal = preprocessing.get_encoded_sequences(file_path, encoder, max_length)
+            # Write to a temporary directory first so an interrupted run never leaves a half-written shard
+            tmp_dir = f'{out_dir}.tmp'
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            os.makedirs(tmp_dir)
+            np.save(os.path.join(tmp_dir, 'X.npy'), X)
+            np.save(os.path.join(tmp_dir, 'y.npy'), np.stack([y_pitch, y_vertical, y_horizontal], axis=1))
+            with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+                json.dump(meta, f, indent=2)
+            shutil.rmtree(out_dir, ignore_errors=True)
+            os.replace(tmp_dir, out_dir)
+        pitchers.append(pitcher)
+    encoder.save(os.path.join(shard_dir, 'encoder.json'))
+    with open(os.path.join(shard_dir, 'pitchers.json'), 'w') as f:
+        json.dump(pitchers, f, indent=2)
+    return pitchers
+
+
+def load_shard_info(shard_dir):
+    """
+    Encoder and pitcher names saved by write_shards.
+    Raises ValueError when a shard was written with another encoder or max_length than the others, since its codes
+    or window shape would not match.
+    """
+    with open(os.path.join(shard_dir, 'pitchers.json')) as f:
+        pitchers = json.load(f)
+    encoder = FeatureEncoder.load(os.path.join(shard_dir, 'encoder.json'))
+    metas = {pitcher: _shard_meta(os.path.join(shard_dir, pitcher)) for pitcher in pitchers}
+    stale = [pitcher for pitcher, meta in metas.items() if meta is None or meta['encoder'] != encoder.fingerprint()]
+    if stale:
+        raise ValueError(f'Shards {stale} were not written with the encoder of {shard_dir}; run write_shards again')
+    max_lengths = {pitcher: meta['max_length'] for pitcher, meta in metas.items()}
+    if len(set(max_lengths.values())) > 1:
+        raise ValueError(f'Shards of {shard_dir} have different max_length values {max_lengths}; '
+                         f'run write_shards again')
+    return encoder, pitchers
+
+
+def _read_shard(shard_dir, pitcher, pitcher_id, split, block_size):
+    """
+    Generator over one pitcher's shard in blocks of block_size samples.
+    split is an index into the (train, val, test) split of the shard, or -1 for every sample.
+    """
+    shard = os.path.join(shard_dir.decode(), pitcher.decode())
+    X = np.load(os.path.join(shard, 'X.npy'), mmap_mode='r')
+    y = np.load(os.path.join(shard, 'y.npy'), mmap_mode='r')
+    indices = np.arange(len(X)) if split < 0 else np.sort(split_indices(len(X))[split])
+    for start in range(0, len(indices), block_size):
+        block = indices[start: start + block_size]
+        yield X[block], np.full(len(block), pitcher_id, dtype=np.int32), y[block]
+
+
+def make_dataset(shard_dir, split=None, batch_size=64, shuffle=False, shuffle_buffer=10000, cycle_length=4,
+                 block_size=256, seed=None):
+    """
+    tf.data pipeline that interleaves the shards of every pitcher.
+    Each shard is read by its own generator and cycle_length shards are read in parallel, so a batch mixes pitchers.
+    Samples are split per pitcher with the notebooks' train_test_split calls, so every pitcher is represented in
+    every split.
+    Args
+        shard_dir: output directory of write_shards.
+        split: 'train', 'val', 'test' or None for every sample.
+        batch_size: number of samples per batch.
+        shuffle: shuffle the shard order and the samples within shuffle_buffer.
+        cycle_length: number of shards read at the same time.
+        block_size: number of samples read from a shard at a time.
+        seed: seed of the shuffling.
+    Returns
+        tf.data.Dataset of ({'input': X, 'pitcher': pitcher_id}, {'pitch_output': ..., 'vertical_output': ...,
+        'horizontal_output': ...}) batches with one-hot float32 labels.
+    """
+    encoder, pitchers = load_shard_info(shard_dir)
+    split_id = -1 if split is None else SPLITS[split]
+    X_shape = np.load(os.path.join(shard_dir, pitchers[0], 'X.npy'), mmap_mode='r').shape[1:]
+    signature = (tf.TensorSpec(shape=(None,) + X_shape, dtype=tf.int8),
+                 tf.TensorSpec(shape=(None,), dtype=tf.int32),
+                 tf.TensorSpec(shape=(None, 3), dtype=tf.int8))
+
+    def read_shard(pitcher_id, pitcher):
+        return tf.data.Dataset.from_generator(_read_shard, output_signature=signature,
+                                              args=(shard_dir, pitcher, pitcher_id, split_id, block_size))
+
+    shards = tf.data.Dataset.from_tensor_slices((np.arange(len(pitchers), dtype=np.int32), pitchers))
+    if shuffle:
+        shards = shards.shuffle(len(pitchers), seed=seed, reshuffle_each_iteration=True)
+    dataset = shards.interleave(read_shard, cycle_length=cycle_length, num_parallel_calls=tf.data.AUTOTUNE,
+                                deterministic=not shuffle)
+    dataset = dataset.unbatch()
+    if shuffle:
+        dataset = dataset.shuffle(shuffle_buffer, seed=seed, reshuffle_each_iteration=True)
+
+    def to_inputs(X, pitcher_id, y):
+        # A pitch type code of -1 (missing) gives an all-zero row, like pd.get_dummies
+        y = tf.cast(y, tf.int32)
+        return ({'input': tf.cast(X, tf.float32), 'pitcher': pitcher_id},
+                {'pitch_output': tf.one_hot(y[:, 0], encoder.n_pitch_types),
+                 'vertical_output': tf.one_hot(y[:, 1], N_LOCATIONS),
+                 'horizontal_output': tf.one_hot(y[:, 2], N_LOCATIONS)})
+
+    return dataset.batch(batch_size).map(to_inputs, num_parallel_calls=tf.data.AUTOTUNE).prefetch(tf.data.AUTOTUNE)
+
+
+def build_unified_model(build_network, encoder, n_pitchers, max_length=6, pitcher_embedding_dim=8,
+                        embedding_dim=None, head_params=None):
+    """
+    Three-head ensemble shared by every pitcher, with a learned pitcher embedding appended to every timestep.
+    Args
+        build_network: the notebooks' build_network(input_layer, num_targets, name, **params) function of the model
+            family to train (LSTM, GRU, ...).
+        encoder: FeatureEncoder the shards were written with.
+        n_pitchers: number of pitcher ids.
+        max_length: number of timesteps per sequence.
+        pitcher_embedding_dim: size of the pitcher embedding.
+        embedding_dim: optional embedding size of the categorical features; one-hot when None.
+        head_params: optional dict mapping 'pitch', 'vertical' and 'horizontal' to build_network keyword arguments.
+    Returns
+        compiled model with inputs {'input', 'pitcher'}.
+    """
+    head_params = head_params or {}
+    input_layer, x = encoded_inputs(encoder, max_length, embedding_dim=embedding_dim)
+    pitcher_input = tf.keras.Input(shape=(), dtype='int32', name='pitcher')
+    pitcher = tf.keras.layers.Embedding(n_pitchers, pitcher_embedding_dim, name='pitcher_embedding')(pitcher_input)
+    pitcher = tf.keras.layers.RepeatVector(max_length, name='pitcher_timesteps')(pitcher)
+    x = tf.keras.layers.Concatenate(name='features_with_pitcher')([x, pitcher])
+
+    outputs = [build_network(x, num_targets=num_targets, name=name, **head_params.get(name, {}))
+               for name, num_targets in [('pitch', encoder.n_pitch_types), ('vertical', N_LOCATIONS),
+                                         ('horizontal', N_LOCATIONS)]]
+    model = tf.keras.models.Model(inputs={'input': input_layer, 'pitcher': pitcher_input}, outputs=outputs)
+    model.compile(optimizer='adam',
+                  loss={'pitch_output': 'categorical_crossentropy',
+                        'vertical_output': 'categorical_crossentropy',
+                        'horizontal_output': 'categorical_crossentropy'},
+                  metrics=['accuracy', 'accuracy', 'accuracy'])
+    return model
+
+
+def train_unified(file_paths, build_network, out_dir, encoder=None, max_length=6, epochs=100, batch_size=64,
+                  callbacks=None, seed=None, **model_kwargs):
+    """
+    Train one model for a whole staff instead of one model per pitcher.
+    Args
+        file_paths: raw Statcast csv files, one per pitcher.
+        build_network: the notebooks' build_network function of the model family to train.
+        out_dir: directory for the shards (out_dir/shards) and the trained model (out_dir/model.keras).
+        encoder: shared FeatureEncoder. Defaults to the league vocabulary.
+        max_length: number of timesteps per sequence.
+        epochs, batch_size, callbacks: passed to fit.
+        seed: seed of the shuffling.
+        model_kwargs: passed to build_unified_model, e.g. pitcher_embedding_dim or head_params.
+    Returns
+        model, history
+    """
+    shard_dir = os.path.join(out_dir, 'shards')
+    pitchers = write_shards(file_paths, encoder or FeatureEncoder(), shard_dir, max_length=max_length)
+    encoder, _ = load_shard_info(shard_dir)
+    train = make_dataset(shard_dir, 'train', batch_size=batch_size, shuffle=True, seed=seed)
+    val = make_dataset(shard_dir, 'val', batch_size=batch_size)
+
+    model = build_unified_model(build_network, encoder, len(pitchers), max_length=max_length, **model_kwargs)
+    history = model.fit(train, epochs=epochs, validation_data=val, callbacks=callbacks, verbose=0)
+    model.save(os.path.join(out_dir, 'model.keras'))
+    return model, history
+
+
+def load_unified(out_dir):
+    """
+    Load a model saved by train_unified for serving.
+    Returns
+        model, encoder, pitcher_ids: pitcher_ids maps a pitcher name to the id to pass as the 'pitcher' input.
+    """
+    encoder, pitchers = load_shard_info(os.path.join(out_dir, 'shards'))
+    model = tf.keras.models.load_model(os.path.join(out_dir, 'model.keras'))
+    return model, encoder, {pitcher: i for i, pitcher in enumerate(pitchers)}
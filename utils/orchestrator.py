@@ -0,0 +1,108 @@
+import json
+import multiprocessing
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor, wait
+import pandas as pd
+from utils import preprocessing
+
+
+def set_thread_budget(n_threads):
+    """
+    Process pool initializer that limits TensorFlow (and the BLAS libraries under numpy) to n_threads.
+    The environment variables are set before tensorflow is imported so they take effect in the worker.
+    """
+    for var in ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS',
+                'TF_NUM_INTRAOP_THREADS', 'TF_NUM_INTEROP_THREADS']:
+        os.environ[var] = str(n_threads)
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(n_threads)
+    tf.config.threading.set_inter_op_parallelism_threads(max(1, n_threads // 2))
+
+
+def _result_path(results_dir, pitcher):
+    return os.path.join(results_dir, f'{pitcher}.json')
+
+
+def _prepare(pitcher, data_dir, results_dir, max_length):
+    # Write the pitcher's sequences once; a finished directory is reused when resuming
+    sequences_dir = os.path.join(results_dir, pitcher, 'sequences')
+    if not os.path.isdir(sequences_dir):
+        tmp_dir = f'{sequences_dir}.tmp'
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        preprocessing.write_sequences(os.path.join(data_dir, f'{pitcher}.csv'), tmp_dir, max_length=max_length)
+        os.replace(tmp_dir, sequences_dir)
+    return sequences_dir
+
+
+def _run(train_fn, pitcher, sequences_dir, artifacts_dir):
+    os.makedirs(artifacts_dir, exist_ok=True)
+    result = train_fn(pitcher, sequences_dir, artifacts_dir)
+    return {'Pitcher': pitcher, **result}
+
+
+def train_pitchers(pitchers, train_fn, results_dir, data_dir=os.path.join('data', 'raw'), n_workers=None,
+                   threads_per_worker=None, max_length=6, mp_context=None):
+    """
+    Train one model per pitcher in a process pool.
+    The parent process preprocesses the pitchers one after another and hands each one to the pool as soon as its
+    sequences are written, so pitcher N+1 is preprocessed while pitcher N trains. Each result is written to
+    results_dir/<pitcher>.json when it finishes; pitchers that already have a result are skipped, so rerunning after a
+    crash resumes where it stopped.
+    Args
+        pitchers: pitcher names; data is read from data_dir/<pitcher>.csv.
+        train_fn: function train_fn(pitcher, sequences_dir, artifacts_dir) -> dict of results. The workers are
+            spawned, so it must be importable by them, i.e. defined in a module rather than in a notebook cell.
+            sequences_dir can be opened with utils.sequence_store.open_sequences; artifacts_dir is where the model,
+            figures etc. should be saved.
+        results_dir: directory for results, sequences and artifacts.
+        data_dir: directory of the raw Statcast csv files.
+        n_workers: number of training processes. Defaults to the number of pitchers, capped by the cpu count.
+        threads_per_worker: TensorFlow thread budget of every worker. Defaults to splitting the cpus evenly.
+        max_length: number of timesteps per sequence.
+        mp_context: multiprocessing context of the pool. Defaults to spawn: the notebooks import tensorflow before
+            calling this, and a forked worker would inherit its initialized runtime, which can deadlock and no longer
+            accepts the thread budget of set_thread_budget.
+    Returns
+        results_df: one row per finished pitcher, including results from earlier runs.
+    """
+    os.makedirs(results_dir, exist_ok=True)
+    mp_context = mp_context or multiprocessing.get_context('spawn')
+    n_cpus = os.cpu_count() or 1
+    if n_workers is None:
+        n_workers = max(1, min(len(pitchers), n_cpus))
+    if threads_per_worker is None:
+        threads_per_worker = max(1, n_cpus // n_workers)
+
+    pending = [pitcher for pitcher in pitchers if not os.path.exists(_result_path(results_dir, pitcher))]
+    if len(pending) < len(pitchers):
+        print(f'Skipping {len(pitchers) - len(pending)} pitchers with existing results.')
+
+    def write_result(future, pitcher):
+        if future.exception() is not None:
+            print(f'Training failed for {pitcher}: {future.exception()!r}')
+            return
+        # Write to a temporary file first so a crash never leaves a half-written result
+        path = _result_path(results_dir, pitcher)
+        with open(f'{path}.tmp', 'w') as f:
+            json.dump(future.result(), f, default=float)
+        os.replace(f'{path}.tmp', path)
+        print(f'Finished training model for {pitcher}.')
+
+    with ProcessPoolExecutor(max_workers=n_workers, mp_context=mp_context,
+                             initializer=set_thread_budget, initargs=(threads_per_worker,)) as pool:
+        futures = []
+        for pitcher in pending:
+            sequences_dir = _prepare(pitcher, data_dir, results_dir, max_length)
+            artifacts_dir = os.path.join(results_dir, pitcher, 'artifacts')
+            future = pool.submit(_run, train_fn, pitcher, sequences_dir, artifacts_dir)
+            future.add_done_callback(lambda future, pitcher=pitcher: write_result(future, pitcher))
+            futures.append(future)
+        wait(futures)
+
+    results = []
+    for pitcher in pitchers:
+        if os.path.exists(_result_path(results_dir, pitcher)):
+            with open(_result_path(results_dir, pitcher)) as f:
+                results.append(json.load(f))
+    return pd.DataFrame(results)
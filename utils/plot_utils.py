@@ -1,4 +1,7 @@
-import matplotlib.pyplot as plt
+from utils.lazy import LazyModule
+
+# pyplot is only imported when a figure is drawn
+plt = LazyModule('matplotlib.pyplot')
 
 # Function to smooth the curve
 # Code adapted from Chollet (2021)
@@ -1,13 +1,45 @@
+import numpy as np
 import pandas as pd
+from utils import instrumentation
+from utils.encoder import FeatureEncoder
+from utils.instrumentation import timed
 from utils.sequencer import Sequencer
 
+# Raw Statcast columns needed by add_plate_app_id, sort_data, engineer_features and select_features,
+# read with compact dtypes so streaming ingestion does not load the full export
+RAW_DTYPES = {
+    'game_type': 'category',
+    'game_date': 'str',
+    'game_pk': 'int32',
+    'batter': 'int32',
+    'at_bat_number': 'int16',
+    'pitch_number': 'int16',
+    'pitch_type': 'category',
+    'zone': 'float32',
+    'on_3b': 'float32',
+    'on_2b': 'float32',
+    'on_1b': 'float32',
+    'inning_topbot': 'category',
+    'home_score': 'int16',
+    'away_score': 'int16',
+    'inning': 'int8',
+    'balls': 'int8',
+    'strikes': 'int8',
+    'outs_when_up': 'int8',
+}
+
+PLATE_APP_COLUMNS = ['game_pk', 'batter', 'at_bat_number']
+
 
 def filter_pitch_types(data, valid_pitch_dict):
     return data[data['pitch_type'].str.contains('|'.join(list(valid_pitch_dict.keys())), na=False)]
 
 
+@timed('preprocessing.filter_regular_season')
 def filter_regular_season(data):
-    return data[data['game_type'] == 'R']
+    filtered = data[data['game_type'] == 'R']
+    instrumentation.count('preprocessing.rows_filtered', len(data) - len(filtered))
+    return filtered
 
 
 def get_repertoire(data):
@@ -23,23 +55,98 @@ def calculate_top_pitch(data, valid_pitch_dict):
     print(f'{top_pitch_name} is thrown {top_pitch_freq}% of the time')
 
 
+@timed('preprocessing.add_plate_app_id')
 def add_plate_app_id(data):
     data['plate_app_id'] = data['game_pk'].astype(str) + data['batter'].astype(str) + data['at_bat_number'].astype(str)
     return data
 
 
+@timed('preprocessing.sort_data')
 def sort_data(data):
     return data.sort_values(['game_date', 'game_pk', 'plate_app_id', 'pitch_number'], ascending=True)
 
 
-def score_diff(row):
+def score_diff(data):
+    # Runs ahead (positive) or behind (negative) from the pitching team's point of view
+    return np.where(data['inning_topbot'] == 'Top',
+                    data['home_score'] - data['away_score'],
+                    data['away_score'] - data['home_score'])
+
+
+def previous_in_at_bat(data, col):
+    # Shift within each plate appearance so the first pitch of an at-bat never sees the previous at-bat
+    return data.groupby('plate_app_id', sort=False)[col].shift(1)
+
+
+def count_state(data):
+    # Ball-strike count as a single code from 0 (0-0) to 11 (3-2)
+    return data['balls'] * 3 + data['strikes']
+
+
+@timed('preprocessing.engineer_features')
+def engineer_features(data, derived_features=None):
+    """
+    Add the engineered columns to a sorted frame.
+    Every step is a column-wise numpy/pandas operation; there are no per-row Python calls.
+    Args
+        data: frame from sort_data.
+        derived_features: optional list of (name, function) pairs. Each function takes the frame and returns a
+            column, e.g. ('count_state', count_state). They run after the built-in features, in order.
+    """
+    data['previous_pitch'] = previous_in_at_bat(data, 'pitch_type')
+    data['previous_zone'] = previous_in_at_bat(data, 'zone')
+
+    on_base_cols = ['on_3b', 'on_2b', 'on_1b']
+    for col in on_base_cols:
+        data[col] = np.where(data[col].fillna(0) != 0, 1, 0)
+
+    data['score_diff'] = score_diff(data)
+    for name, function in derived_features or []:
+        data[name] = function(data)
+    return data
+
+
+def _feature_names(derived_features):
+    return [name for name, _ in derived_features or []]
+
+
+@timed('preprocessing.select_features')
+def select_features(data, extra_features=()):
+    selected_features = [
+        'plate_app_id', 'previous_pitch', 'previous_zone', 'pitch_number',
+        'inning', 'on_3b', 'on_2b', 'on_1b', 'score_diff', 'balls', 'strikes', 'outs_when_up', *extra_features,
+        'pitch_type', 'zone'
+    ]
+    return data[selected_features]
+
+
+# Location of each Statcast zone, indexed by zone number. Index 0 stands for a missing zone.
+VERTICAL_ZONES = np.array([2, 0, 0, 0, 1, 1, 1, 2, 2, 2, 2, 0, 0, 2, 2])
+HORIZONTAL_ZONES = np.array([2, 0, 1, 2, 0, 1, 2, 0, 1, 2, 2, 0, 2, 0, 2])
+
+
+@timed('preprocessing.get_zones')
+def get_zones(data):
+    zone = data['zone'].fillna(0).to_numpy().astype(int)
+    zone = np.where((zone >= 0) & (zone < len(VERTICAL_ZONES)), zone, 0)
+    data['vertical_location'] = VERTICAL_ZONES.take(zone)
+    data['horizontal_location'] = HORIZONTAL_ZONES.take(zone)
+    data = data.drop(columns=['zone'])
+    return data
+
+
+def score_diff_reference(row):
     if row['inning_topbot'] == 'Top':
         return row['home_score'] - row['away_score']
     else:
         return row['away_score'] - row['home_score']
 
 
-def engineer_features(data):
+def engineer_features_reference(data):
+    """
+    Original row-wise implementation of engineer_features, kept for benchmarking.
+    Unlike engineer_features, its previous_pitch/previous_zone leak across at-bats when pitch 1 of an at-bat is missing.
+    """
     data['previous_pitch'] = data['pitch_type'].shift(1)
     data.loc[data['pitch_number'] == 1, 'previous_pitch'] = None
 
@@ -51,19 +158,12 @@ def engineer_features(data):
         data[col] = data[col].fillna(0).astype(int)
         data.loc[data[col] != 0, col] = 1
 
-    data['score_diff'] = data.apply(score_diff, axis=1)
+    data['score_diff'] = data.apply(score_diff_reference, axis=1)
     return data
 
 
-def select_features(data):
-    selected_features = [
-        'plate_app_id', 'previous_pitch', 'previous_zone', 'pitch_number',
-        'inning', 'on_3b', 'on_2b', 'on_1b', 'score_diff', 'balls', 'strikes', 'outs_when_up', 'pitch_type', 'zone'
-    ]
-    return data[selected_features]
-
-
-def get_zones(data):
+def get_zones_reference(data):
+    # Original implementation of get_zones, kept for benchmarking
     data['vertical_location'] = data['zone'].apply(lambda x:
                                                    0 if x in [1, 2, 3, 11, 12]
                                                    else 1 if x in [4, 5, 6]
@@ -76,37 +176,254 @@ def get_zones(data):
     return data
 
 
-def preprocess_data(file_path):
+@timed('preprocessing.preprocess_data')
+def preprocess_data(file_path, cache=None, categories=None, derived_features=None):
+    """
+    Run the feature pipeline on a raw Statcast csv.
+    Args
+        file_path: path to the raw Statcast csv.
+        cache: optional utils.cache.FeatureCache. A warm entry skips parsing the csv entirely.
+        categories: optional fixed vocabulary (see scan_categories) for the dummy columns.
+            By default the dummy columns are the values found in the file.
+        derived_features: optional extra features, see engineer_features. They are kept as feature columns.
+    """
+    if cache is not None:
+        key = cache.key(file_path, 'features', categories=categories,
+                        derived_features=_feature_names(derived_features))
+        data = cache.load_frame(key)
+        if data is not None:
+            return data
+
     data = pd.read_csv(file_path)
     data = filter_regular_season(data)
     # repertoire_abb, repertoire_full = get_repertoire(data)
     # calculate_top_pitch(data, valid_pitch_dict)
     data = add_plate_app_id(data)
     data = sort_data(data)
-    data = engineer_features(data)
-    data = select_features(data)
-    data = pd.get_dummies(data, columns=['previous_zone', 'previous_pitch', 'inning'], dtype=int)
+    data = engineer_features(data, derived_features)
+    data = select_features(data, _feature_names(derived_features))
+    if categories is None:
+        data = pd.get_dummies(data, columns=['previous_zone', 'previous_pitch', 'inning'], dtype=int)
+    else:
+        data = encode_chunk(data, categories)
     data = get_zones(data)
 
     # data.to_csv(output_path, index=False)
+    if cache is not None:
+        cache.save_frame(key, data)
     return data
 
 
-def get_sequences(file_path):
-    data = preprocess_data(file_path)
+def make_sequencer(file_path, max_length=6, cache=None, categories=None, derived_features=None):
+    # Preprocess a raw file and wrap it in a Sequencer ready to produce sequences
+    data = preprocess_data(file_path, cache=cache, categories=categories, derived_features=derived_features)
     # Number of features equals to the number of columns minus
     n_features = data.shape[0] - 3
-    data = pd.get_dummies(data, columns=[
-                          'pitch_type', 'vertical_location', 'horizontal_location'], dtype=int)
+    if categories is None:
+        data = pd.get_dummies(data, columns=[
+                              'pitch_type', 'vertical_location', 'horizontal_location'], dtype=int)
+    else:
+        data = encode_labels(data, categories)
     n_pitch_types = len([col for col in data.columns if col.startswith('pitch_type_')])
     n_vertical_locs = len([col for col in data.columns if col.startswith('vertical_location_')])
     n_horizontal_locs = len([col for col in data.columns if col.startswith('horizontal_location_')])
 
+    return Sequencer(data=data,
+                     max_length=max_length,
+                     n_features=n_features,
+                     n_pitch_types=n_pitch_types,
+                     n_vertical_locs=n_vertical_locs,
+                     n_horizontal_locs=n_horizontal_locs
+                     )
+
+
+@timed('preprocessing.get_sequences')
+def get_sequences(file_path, max_length=6, cache=None, categories=None, derived_features=None):
+    if cache is not None:
+        key = cache.key(file_path, 'sequences', max_length=max_length, categories=categories,
+                        derived_features=_feature_names(derived_features))
+        sequences = cache.load_sequences(key)
+        if sequences is not None:
+            return sequences
+
+    seq = make_sequencer(file_path, max_length=max_length, cache=cache, categories=categories,
+                         derived_features=derived_features)
+    sequences = seq.make_sequences()
+    if cache is not None:
+        cache.save_sequences(key, sequences)
+    return sequences
+
+
+@timed('preprocessing.write_sequences')
+def write_sequences(file_path, out_dir, max_length=6, categories=None, dtype='int8', derived_features=None):
+    """
+    Memory-mapped version of get_sequences.
+    The tensors are written once to .npy files in out_dir with a compact dtype and are never held in memory as float64.
+    Open them with utils.sequence_store.open_sequences.
+    Returns
+        the shapes of X, y_pitch, y_vertical and y_horizontal.
+    """
+    seq = make_sequencer(file_path, max_length=max_length, categories=categories, derived_features=derived_features)
+    return seq.write_sequences(out_dir, dtype=dtype)
+
+
+def fit_encoder(file_paths, chunksize=100000):
+    # Fit a FeatureEncoder on the union of the values found in several files, e.g. a whole league
+    return FeatureEncoder.from_categories([scan_categories(file_path, chunksize) for file_path in file_paths])
+
+
+@timed('preprocessing.preprocess_encoded')
+def preprocess_encoded(file_path, encoder, derived_features=None):
+    """
+    Compact counterpart of preprocess_data: the same pipeline, but encoded with a FeatureEncoder into int8 codes
+    instead of per-file dummy columns.
+    The encoder only knows the fixed feature set, so derived_features raise a ValueError in encoder.transform rather
+    than being dropped.
+    """
+    data = pd.read_csv(file_path)
+    data = filter_regular_season(data)
+    data = add_plate_app_id(data)
+    data = sort_data(data)
+    data = engineer_features(data, derived_features)
+    data = select_features(data, _feature_names(derived_features))
+    data = get_zones(data)
+    return encoder.transform(data)
+
+
+def get_encoded_sequences(file_path, encoder, max_length=6):
+    """
+    Compact counterpart of get_sequences.
+    Returns
+        X: (samples, max_length, len(encoder.columns)) int8 codes; expand per batch with encoder.expand.
+        y_pitch, y_vertical, y_horizontal: (samples,) int8 class codes; -1 marks a missing pitch type.
+    """
+    data = preprocess_encoded(file_path, encoder)
     seq = Sequencer(data=data,
-                    max_length=6,
-                    n_features=n_features,
-                    n_pitch_types=n_pitch_types,
-                    n_vertical_locs=n_vertical_locs,
-                    n_horizontal_locs=n_horizontal_locs
+                    max_length=max_length,
+                    n_features=len(encoder.columns),
+                    n_pitch_types=1,
+                    n_vertical_locs=1,
+                    n_horizontal_locs=1
                     )
-    return seq.make_sequences()
+    # Gather straight from the int8 per-pitch matrices, so no float64 window tensor is ever built
+    X, y_pitch, y_vertical, y_horizontal = seq.make_compact(dtype=np.int8).gather()
+    return X, y_pitch.ravel(), y_vertical.ravel(), y_horizontal.ravel()
+
+
+def read_raw_chunks(file_path, chunksize=100000):
+    """
+    Read a raw Statcast export in chunks that never split a plate appearance.
+    Only the columns in RAW_DTYPES are parsed. The rows of the last plate appearance in every chunk are carried over
+    to the next one, so each yielded frame holds complete at-bats and peak memory is bounded by chunksize.
+    Args
+        file_path: path to the raw Statcast csv.
+        chunksize: number of csv rows parsed at a time.
+    Returns
+        generator of DataFrames with the RAW_DTYPES columns.
+    """
+    carry = None
+    for chunk in pd.read_csv(file_path, usecols=list(RAW_DTYPES), dtype=RAW_DTYPES, chunksize=chunksize):
+        if carry is not None:
+            chunk = pd.concat([carry, chunk], ignore_index=True)
+        # Hold back the plate appearance of the last row; it may continue in the next chunk
+        last = chunk[PLATE_APP_COLUMNS].iloc[-1]
+        is_last = (chunk[PLATE_APP_COLUMNS] == last).all(axis=1)
+        carry = chunk[is_last]
+        if (~is_last).any():
+            yield chunk[~is_last]
+    if carry is not None and len(carry):
+        yield carry
+
+
+def scan_categories(file_path, chunksize=100000):
+    """
+    Collect the values of the one-hot encoded columns over a whole file without holding it in memory.
+    Streaming chunks are encoded against this vocabulary so every chunk has the same columns.
+    Returns
+        categories: dict mapping 'pitch_type', 'zone' and 'inning' to their sorted regular season values.
+    """
+    pitch_types, zones, innings = set(), set(), set()
+    for chunk in pd.read_csv(file_path, usecols=['game_type', 'pitch_type', 'zone', 'inning'],
+                             dtype={key: RAW_DTYPES[key] for key in ['game_type', 'pitch_type', 'zone', 'inning']},
+                             chunksize=chunksize):
+        chunk = filter_regular_season(chunk)
+        pitch_types.update(chunk['pitch_type'].dropna().unique())
+        zones.update(chunk['zone'].dropna().unique())
+        innings.update(chunk['inning'].unique())
+    return {'pitch_type': sorted(pitch_types), 'zone': sorted(zones), 'inning': sorted(innings)}
+
+
+def encode_chunk(data, categories):
+    # One-hot encode against a fixed vocabulary so the columns do not depend on the values in the chunk
+    data = data.copy()
+    data['previous_zone'] = pd.Categorical(data['previous_zone'], categories=categories['zone'])
+    data['previous_pitch'] = pd.Categorical(data['previous_pitch'], categories=categories['pitch_type'])
+    data['inning'] = pd.Categorical(data['inning'], categories=categories['inning'])
+    return pd.get_dummies(data, columns=['previous_zone', 'previous_pitch', 'inning'], dtype=int)
+
+
+def encode_labels(data, categories):
+    # Label counterpart of encode_chunk
+    data = data.copy()
+    data['pitch_type'] = pd.Categorical(data['pitch_type'], categories=categories['pitch_type'])
+    data['vertical_location'] = pd.Categorical(data['vertical_location'], categories=[0, 1, 2])
+    data['horizontal_location'] = pd.Categorical(data['horizontal_location'], categories=[0, 1, 2])
+    return pd.get_dummies(data, columns=['pitch_type', 'vertical_location', 'horizontal_location'], dtype=int)
+
+
+def iter_preprocessed_chunks(file_path, chunksize=100000, categories=None, derived_features=None):
+    """
+    Streaming version of preprocess_data.
+    Runs the same pipeline on each chunk from read_raw_chunks and encodes it against a fixed vocabulary.
+    Args
+        file_path: path to the raw Statcast csv.
+        chunksize: number of csv rows parsed at a time.
+        categories: output of scan_categories. Scanned from the file when not given.
+        derived_features: optional extra features, see engineer_features. They may only use the RAW_DTYPES columns.
+    Returns
+        generator of feature frames with the same columns as preprocess_data would produce for the whole file.
+    """
+    if categories is None:
+        categories = scan_categories(file_path, chunksize)
+    for data in read_raw_chunks(file_path, chunksize):
+        data = filter_regular_season(data)
+        if data.empty:
+            continue
+        data = preprocess_frame(add_plate_app_id(data.copy()), categories, derived_features)
+        instrumentation.count('preprocessing.chunks')
+        yield data
+
+
+def preprocess_frame(data, categories, derived_features=None):
+    # Feature pipeline of a regular season frame holding complete plate appearances, from sort_data to get_zones
+    data = sort_data(data)
+    data = engineer_features(data, derived_features)
+    data = select_features(data, _feature_names(derived_features))
+    data = encode_chunk(data, categories)
+    return get_zones(data)
+
+
+def iter_sequences(file_path, max_length=6, chunksize=100000, categories=None, derived_features=None):
+    """
+    Streaming version of get_sequences.
+    Sequences every chunk from iter_preprocessed_chunks on its own; no at-bat is split across chunks.
+    Returns
+        generator of (X, y_pitch, y_vertical, y_horizontal) tuples with the same width for every chunk.
+    """
+    if categories is None:
+        categories = scan_categories(file_path, chunksize)
+    for data in iter_preprocessed_chunks(file_path, chunksize, categories, derived_features):
+        yield frame_sequencer(data, categories, max_length).make_sequences()
+
+
+def frame_sequencer(data, categories, max_length=6):
+    # Sequencer over a frame from preprocess_frame, with labels encoded against the same vocabulary
+    n_pitch_types = len(categories['pitch_type'])
+    data = encode_labels(data, categories)
+    return Sequencer(data=data,
+                     max_length=max_length,
+                     n_features=data.shape[1] - n_pitch_types - 7,
+                     n_pitch_types=n_pitch_types,
+                     n_vertical_locs=3,
+                     n_horizontal_locs=3
+                     )
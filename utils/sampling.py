@@ -0,0 +1,167 @@
+import numpy as np
+
+
+def class_codes(y, block_size=65536):
+    """
+    Class code of every row of a one-hot label matrix, read in blocks so memmaps are never loaded whole.
+    Rows without a label (all zeros, as pd.get_dummies gives for a missing value) get -1. Labels that already are
+    (batch,) class codes are returned as int64.
+    """
+    if np.ndim(y) == 1:
+        return np.asarray(y).astype(np.int64)
+    codes = np.empty(len(y), dtype=np.int64)
+    for start in range(0, len(y), block_size):
+        block = np.asarray(y[start: start + block_size])
+        codes[start: start + len(block)] = np.where(block.any(axis=1), block.argmax(axis=1), -1)
+    return codes
+
+
+def stratum_ids(*codes):
+    """
+    Combine one or more code arrays (e.g. pitch type, vertical and horizontal location) into a single stratum id.
+    Returns
+        ids: stratum of every sample, numbered 0..n_strata - 1, or -1 where any code is missing (-1).
+        n_strata: number of distinct combinations.
+    """
+    codes = np.stack(codes, axis=1)
+    labelled = (codes >= 0).all(axis=1)
+    ids = np.full(len(codes), -1, dtype=np.int64)
+    if labelled.any():
+        _, inverse = np.unique(codes[labelled], axis=0, return_inverse=True)
+        ids[labelled] = inverse.reshape(-1)
+    return ids, int(ids.max()) + 1
+
+
+def stratum_weights(ids, temperature=1.0, weights=None):
+    """
+    Per-sample weights that move the stratum distribution from the natural one towards a uniform one.
+    A stratum with n samples gets n ** (1 / temperature) of the total weight: temperature=1 keeps the data as is,
+    temperature=np.inf balances every stratum and values in between flatten the distribution partially.
+    Args
+        ids: stratum of every sample, from stratum_ids. Samples with id -1 get weight 0.
+        temperature: >= 1 in practice; np.inf for fully balanced.
+        weights: optional per-sample base weights (e.g. recency). Strata are then sized by their total weight.
+    Returns
+        sample_weights: float64 array with mean 1, usable as sample_weight in fit.
+    """
+    weights = np.ones(len(ids)) if weights is None else np.asarray(weights, dtype=np.float64)
+    weights = np.where(ids >= 0, weights, 0.0)
+    ids = np.maximum(ids, 0)
+    sizes = np.bincount(ids, weights=weights)
+    present = sizes > 0
+    target = np.zeros_like(sizes)
+    target[present] = 1.0 if np.isinf(temperature) else sizes[present] ** (1.0 / temperature)
+    target /= target.sum()
+    # Spread the target share of each stratum over its samples in proportion to their base weight
+    scale = np.zeros_like(sizes)
+    scale[present] = target[present] / sizes[present]
+    sample_weights = weights * scale[ids]
+    return sample_weights / sample_weights.mean()
+
+
+class StratifiedSampler:
+    """
+    Streaming sampler of index batches with a controlled share of every stratum.
+    Batches are index arrays into the data, so no sample is ever copied: rare pitch types are repeated by drawing
+    their indices more often, not by concatenating arrays.
+    Every batch holds the target share of each stratum (stratum_weights with the given temperature); fractional counts
+    are carried over to the next batches, so a stratum that deserves 0.3 samples per batch appears in about every
+    third one. Within a stratum, samples are drawn in proportion to their weight, without replacement until the
+    stratum is exhausted.
+    Args
+        ids: stratum of every sample, from stratum_ids over class_codes of the heads to balance.
+        indices: rows the sampler may draw, e.g. the training split. Defaults to every row. Rows without a stratum
+            (id -1) are never drawn.
+        temperature: 1 for the natural distribution, np.inf for balanced strata.
+        weights: optional per-sample base weights.
+        batch_size: number of samples per batch.
+        num_batches: batches per epoch. Defaults to one pass over indices.
+        seed: seed of the sampling.
+    """
+    def __init__(self, ids, indices=None, temperature=np.inf, weights=None, batch_size=64, num_batches=None,
+                 seed=None) -> None:
+        ids = np.asarray(ids)
+        self.indices = np.arange(len(ids)) if indices is None else np.asarray(indices)
+        self.indices = self.indices[ids[self.indices] >= 0]
+        self.ids = ids[self.indices]
+        self.weights = None if weights is None else np.asarray(weights, dtype=np.float64)[self.indices]
+        self.temperature = temperature
+        self.batch_size = batch_size
+        self.num_batches = num_batches or (len(self.indices) + batch_size - 1) // batch_size
+        self.rng = np.random.default_rng(seed)
+
+        # Positions (into self.indices) of the samples of every stratum
+        order = np.argsort(self.ids, kind='stable')
+        sizes = np.bincount(self.ids)
+        self.members = np.split(order, np.cumsum(sizes)[:-1])
+        self.sample_weights = stratum_weights(self.ids, temperature, self.weights)
+        # Expected share of every stratum in a batch
+        self.shares = np.bincount(self.ids, weights=self.sample_weights) / len(self.ids)
+        self.credit = np.zeros(len(sizes))
+        self.queues = [np.empty(0, dtype=np.int64) for _ in sizes]
+        # Row of the data -> position in indices, for looking up the weights of a batch
+        self.positions = np.full(self.indices.max() + 1 if len(self.indices) else 0, -1, dtype=np.int64)
+        self.positions[self.indices] = np.arange(len(self.indices))
+
+    def __len__(self):
+        return self.num_batches
+
+    def _refill(self, stratum):
+        # A new pass over the stratum: a random order, weighted by the base weights when given
+        members = self.members[stratum]
+        if self.weights is None:
+            return self.rng.permutation(members)
+        p = self.weights[members]
+        if p.sum() == 0:
+            return self.rng.permutation(members)
+        # Weighted order without replacement (exponential keys)
+        keys = self.rng.exponential(size=len(members)) / np.maximum(p, 1e-12)
+        return members[np.argsort(keys)]
+
+    def _take(self, stratum, count):
+        taken = []
+        while count > 0:
+            if len(self.queues[stratum]) == 0:
+                self.queues[stratum] = self._refill(stratum)
+            part = self.queues[stratum][:count]
+            self.queues[stratum] = self.queues[stratum][count:]
+            taken.append(part)
+            count -= len(part)
+        return taken
+
+    def _counts(self):
+        # Whole samples per stratum for the next batch; the fractional rest is carried over
+        self.credit += self.batch_size * self.shares
+        counts = np.floor(self.credit).astype(np.int64)
+        missing = self.batch_size - counts.sum()
+        if missing > 0:
+            # Largest remainders first, ties broken at random
+            remainders = self.credit - counts + self.rng.random(len(counts)) * 1e-9
+            counts[np.argsort(-remainders)[:missing]] += 1
+        self.credit -= counts
+        return counts
+
+    def next_batch(self):
+        """
+        Returns
+            sorted row indices of the next batch (into the full data, not into indices).
+        """
+        positions = []
+        for stratum, count in enumerate(self._counts()):
+            positions.extend(self._take(stratum, count))
+        # Sorting keeps reads from a memory map close together
+        return np.sort(self.indices[np.concatenate(positions)])
+
+    def __iter__(self):
+        for _ in range(self.num_batches):
+            yield self.next_batch()
+
+    def importance_weights(self, batch):
+        """
+        Weights that undo the rebalancing in the loss, for when the sampler should only change how often the rare
+        strata are seen but not what the model is fitted to. They are the inverse of stratum_weights, with mean 1 over
+        indices.
+        """
+        positions = self.positions[batch]
+        natural = np.ones(len(batch)) if self.weights is None else self.weights[positions] / self.weights.mean()
+        return natural / self.sample_weights[positions]
@@ -0,0 +1,219 @@
+import json
+import multiprocessing
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import pandas as pd
+from utils.orchestrator import set_thread_budget
+
+HEADS = ['pitch', 'vertical', 'horizontal']
+
+
+def rung_epochs(max_epochs, min_epochs, eta):
+    # Epoch budgets of the successive halving rungs, e.g. [11, 33, 100] for 100 epochs and eta=3
+    budgets = [max_epochs]
+    while budgets[0] / eta >= min_epochs:
+        budgets.insert(0, int(round(budgets[0] / eta)))
+    return budgets
+
+
+def _space_config(build_model):
+    """
+    Run build_model once on default values and return the config of the search space it registers.
+    This builds a TensorFlow model, so it runs in a short-lived process of its own: a search process that initialized
+    the TensorFlow runtime could no longer give its workers a thread budget.
+    """
+    import keras_tuner
+    hp = keras_tuner.HyperParameters()
+    build_model(hp)
+    return hp.get_config()
+
+
+def _train_trial(build_model, space, values, sequences_dir, trial_dir, initial_epoch, epochs, batch_size, patience):
+    """
+    Train one trial from initial_epoch up to epochs in a worker process.
+    The model is resumed from trial_dir/model.keras when an earlier rung trained it, and saved there afterwards.
+    Returns
+        dict with the best val_<head>_output_accuracy of every head over the epochs of this call (initial_epoch to
+        epochs). HyperbandSearch combines it with the earlier rungs of the trial.
+    """
+    import keras_tuner
+    import tensorflow as tf
+    from utils.callbacks import FreezeOutputCallback
+    from utils.datasets import SequenceBatches
+    from utils.sequence_store import open_sequences, split_indices
+
+    X, y_pitch, y_vertical, y_horizontal = open_sequences(sequences_dir)
+    train_idx, val_idx, _ = split_indices(len(X))
+    train = SequenceBatches(X, y_pitch, y_vertical, y_horizontal, indices=train_idx, batch_size=batch_size,
+                            shuffle=True, seed=initial_epoch)
+    val = SequenceBatches(X, y_pitch, y_vertical, y_horizontal, indices=val_idx, batch_size=batch_size)
+
+    model_path = os.path.join(trial_dir, 'model.keras')
+    if initial_epoch > 0 and os.path.exists(model_path):
+        model = tf.keras.models.load_model(model_path)
+    else:
+        # Registering the space first makes every hp.Int/hp.Choice call in build_model return the trial's value
+        hp = keras_tuner.HyperParameters.from_config(space)
+        hp.values.update(values)
+        model = build_model(hp)
+    history = model.fit(train, epochs=epochs, initial_epoch=initial_epoch, validation_data=val,
+                        callbacks=[FreezeOutputCallback(patience=patience)], verbose=0)
+    os.makedirs(trial_dir, exist_ok=True)
+    model.save(model_path)
+    return {head: float(max(history.history[f'val_{head}_output_accuracy'])) for head in HEADS}
+
+
+class HyperbandSearch:
+    """
+    Parallel, resumable hyperparameter search over the notebooks' build_model(hp) functions.
+    Trials are scheduled with asynchronous successive halving: every new trial trains for the smallest epoch budget,
+    and a trial is promoted to the next budget only when its score is in the top 1/eta of the trials that finished
+    the current one. Promoted trials continue from their saved model instead of starting over. The score of a trial
+    is the sum of its best val_pitch/vertical/horizontal_output_accuracy, like the notebooks' multi-objective tuner.
+    Trials run in a process pool with a bounded TensorFlow thread budget per worker, and read the sequences from the
+    memory-mapped files of Sequencer.write_sequences, so the tensors are never pickled into the workers.
+    Every finished rung is appended to search_dir/trials.jsonl; a new search on the same directory replays the log
+    and only runs what is left.
+    Args
+        build_model: build_model(hp) function returning a compiled three-head model. It must be picklable, i.e.
+            defined in a module, since the workers are spawned.
+        search_dir: directory for the trial log and the trial models.
+        max_trials: number of hyperparameter combinations to try.
+        max_epochs: epoch budget of the last rung.
+        min_epochs: smallest epoch budget of the first rung.
+        eta: reduction factor between rungs.
+        n_workers: number of training processes.
+        threads_per_worker: TensorFlow thread budget of every worker. Defaults to splitting the cpus evenly.
+        patience: patience of the FreezeOutputCallback used in every rung.
+        seed: seed of the hyperparameter sampling.
+        mp_context: multiprocessing context of the pool. Defaults to spawn, so every worker starts with a fresh
+            TensorFlow runtime that accepts its thread budget.
+    """
+    def __init__(self, build_model, search_dir, max_trials=10, max_epochs=100, min_epochs=5, eta=3, n_workers=None,
+                 threads_per_worker=None, patience=5, seed=42, mp_context=None) -> None:
+        self.build_model = build_model
+        self.search_dir = search_dir
+        self.max_trials = max_trials
+        self.rungs = rung_epochs(max_epochs, min_epochs, eta)
+        self.eta = eta
+        self.n_workers = n_workers or max(1, min(max_trials, os.cpu_count() or 1))
+        self.threads_per_worker = threads_per_worker or max(1, (os.cpu_count() or 1) // self.n_workers)
+        self.patience = patience
+        self.seed = seed
+        self.mp_context = mp_context or multiprocessing.get_context('spawn')
+        self.log_path = os.path.join(search_dir, 'trials.jsonl')
+        self.space = None
+        self.trials = {}
+        self.rung_scores = [{} for _ in self.rungs]
+
+    def _load_space(self):
+        # Register the search space in a separate process, so no model is ever built in this one
+        import keras_tuner
+        with ProcessPoolExecutor(max_workers=1, mp_context=self.mp_context) as pool:
+            self.space = pool.submit(_space_config, self.build_model).result()
+        return keras_tuner.HyperParameters.from_config(self.space)
+
+    def _sample(self, hp, trial_number):
+        return {param.name: param.random_sample(self.seed * 1000 + trial_number) for param in hp.space}
+
+    def _replay(self):
+        # Rebuild the trials and rung scores from the log of an earlier run
+        if not os.path.exists(self.log_path):
+            return
+        with open(self.log_path) as f:
+            for line in f:
+                record = json.loads(line)
+                self.trials[record['trial_id']] = {'values': record['values'], 'rung': record['rung'],
+                                                   'metrics': record['metrics'], 'score': record['score']}
+                self.rung_scores[record['rung']][record['trial_id']] = record['score']
+
+    def _log(self, trial_id, rung, metrics):
+        score = sum(metrics.values())
+        trial = self.trials[trial_id]
+        trial.update({'rung': rung, 'metrics': metrics, 'score': score})
+        self.rung_scores[rung][trial_id] = score
+        with open(self.log_path, 'a') as f:
+            f.write(json.dumps({'trial_id': trial_id, 'values': trial['values'], 'rung': rung,
+                                'epochs': self.rungs[rung], 'metrics': metrics, 'score': score}) + '\n')
+
+    def _next_job(self, hp, running):
+        """
+        Pick the next (trial_id, rung) to run: a promotion from the highest possible rung first, otherwise a new
+        trial. Returns None when nothing can run until a running trial finishes.
+        """
+        for rung in reversed(range(len(self.rungs) - 1)):
+            scores = self.rung_scores[rung]
+            ranked = sorted(scores, key=scores.get, reverse=True)[:len(scores) // self.eta]
+            for trial_id in ranked:
+                trial = self.trials[trial_id]
+                if trial_id not in running and trial['rung'] == rung and not trial.get('failed'):
+                    return trial_id, rung + 1
+        if len(self.trials) < self.max_trials:
+            # Number after the last logged trial, so ids stay unique when a failed trial was not logged
+            number = max([int(trial_id) + 1 for trial_id in self.trials], default=0)
+            trial_id = f'{number:02d}'
+            self.trials[trial_id] = {'values': self._sample(hp, number), 'rung': -1, 'metrics': {}, 'score': None}
+            return trial_id, 0
+        return None
+
+    def search(self, sequences_dir, batch_size=64):
+        """
+        Run the search until every trial is either pruned or trained for max_epochs.
+        Args
+            sequences_dir: output directory of Sequencer.write_sequences (or utils.preprocessing.write_sequences).
+            batch_size: batch size of every fit.
+        Returns
+            results_df: trials sorted by score, in the columns of the notebooks' search results plus the epochs each
+                trial was trained for.
+        """
+        os.makedirs(self.search_dir, exist_ok=True)
+        hp = self._load_space()
+        self._replay()
+        if self.trials:
+            print(f'Resuming search with {len(self.trials)} logged trials.')
+
+        running = {}
+        with ProcessPoolExecutor(max_workers=self.n_workers, mp_context=self.mp_context,
+                                 initializer=set_thread_budget, initargs=(self.threads_per_worker,)) as pool:
+            while True:
+                while len(running) < self.n_workers:
+                    job = self._next_job(hp, running.values())
+                    if job is None:
+                        break
+                    trial_id, rung = job
+                    initial_epoch = self.rungs[rung - 1] if rung > 0 else 0
+                    future = pool.submit(_train_trial, self.build_model, self.space, self.trials[trial_id]['values'],
+                                         sequences_dir, os.path.join(self.search_dir, f'trial_{trial_id}'),
+                                         initial_epoch, self.rungs[rung], batch_size, self.patience)
+                    running[future] = trial_id
+                    self.trials[trial_id]['pending_rung'] = rung
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    trial_id = running.pop(future)
+                    rung = self.trials[trial_id].pop('pending_rung')
+                    if future.exception() is not None:
+                        # Not logged, so a resumed search retries it
+                        print(f'Trial {trial_id} failed: {future.exception()!r}')
+                        self.trials[trial_id]['failed'] = True
+                        continue
+                    # A promoted trial keeps the best accuracy of its earlier rungs
+                    previous = self.trials[trial_id]['metrics']
+                    metrics = {head: max(value, previous.get(head, value)) for head, value in future.result().items()}
+                    self._log(trial_id, rung, metrics)
+                    print(f'Trial {trial_id} finished {self.rungs[rung]} epochs with score '
+                          f'{self.trials[trial_id]["score"]:.4f}.')
+        return self.results()
+
+    def results(self):
+        rows = []
+        for trial_id, trial in self.trials.items():
+            if trial['rung'] < 0:
+                continue
+            rows.append({'Trial ID': trial_id, **trial['values'], 'Epochs': self.rungs[trial['rung']],
+                         'Score': trial['score'],
+                         'Pitch Accuracy': trial['metrics']['pitch'],
+                         'Vertical Accuracy': trial['metrics']['vertical'],
+                         'Horizontal Accuracy': trial['metrics']['horizontal']})
+        return pd.DataFrame(rows).sort_values('Score', ascending=False, ignore_index=True) if rows else pd.DataFrame()
@@ -0,0 +1,29 @@
+import os
+import numpy as np
+
+SEQUENCE_FILES = ['X', 'y_pitch', 'y_vertical', 'y_horizontal']
+
+
+def open_sequences(out_dir, mmap_mode='r'):
+    """
+    Open the tensors written by Sequencer.write_sequences without reading them into memory.
+    Returns
+        X, y_pitch, y_vertical, y_horizontal as numpy memmaps.
+    """
+    return tuple(np.load(os.path.join(out_dir, f'{name}.npy'), mmap_mode=mmap_mode) for name in SEQUENCE_FILES)
+
+
+def split_indices(n_samples, test_size=0.4, val_size=0.5, random_states=(54, 42)):
+    """
+    Train/validation/test split as index arrays instead of copies of the tensors.
+    Uses the same two train_test_split calls as the notebooks, so the samples in every split are the same ones the
+    notebooks would get from splitting the arrays directly.
+    Returns
+        train_idx, val_idx, test_idx: integer index arrays into the sequence tensors.
+    """
+    from sklearn.model_selection import train_test_split
+
+    indices = np.arange(n_samples)
+    train_idx, temp_idx = train_test_split(indices, test_size=test_size, random_state=random_states[0])
+    val_idx, test_idx = train_test_split(temp_idx, test_size=val_size, random_state=random_states[1])
+    return train_idx, val_idx, test_idx
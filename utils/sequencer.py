@@ -1,9 +1,87 @@
+import os
 import pandas as pd
 import numpy as np
+from utils import instrumentation
+from utils.instrumentation import timed
+from utils.sampling import class_codes
 
 # Code adapted from: Baseball Pitch Prediction with Deep Learning
 # https://seanjhannon.medium.com/baseball-pitch-prediction-with-deep-learning-df68094fcc65
 
+def check_range(values, dtype):
+    # Raise instead of letting a cast to a compact dtype wrap values that do not fit in it
+    info = np.iinfo(dtype) if np.issubdtype(np.dtype(dtype), np.integer) else np.finfo(dtype)
+    if values.size and (values.min() < info.min or values.max() > info.max):
+        raise ValueError(f'Values in [{values.min()}, {values.max()}] do not fit in {np.dtype(dtype)}')
+
+
+def gather_windows(padded_features, labels, window_starts, window_ends, max_length, label_sizes):
+    """
+    Populate the 3D feature tensor and the label matrices for a set of windows with a single fancy-indexing gather.
+    Args
+        padded_features: (p + 1, f) per-pitch features whose last row is all zeros.
+        labels: (p, l) per-pitch labels.
+        window_starts, window_ends: global row bounds of the windows.
+        max_length: number of timesteps per window; rows past a window's end are padded with zeros.
+        label_sizes: widths of the pitch, vertical and horizontal labels in labels.
+    Returns
+        X, y_pitch, y_vertical, y_horizontal: same layout as the reference make_sequences.
+    """
+    steps = np.arange(max_length)
+    index = window_starts[:, None] + steps
+    index = np.where(index < window_ends[:, None], index, len(padded_features) - 1)
+    X = padded_features[index]
+    # The label of a window is the last real pitch in it
+    y = labels[window_ends - 1]
+    n_pitch_types, n_vertical_locs, _ = label_sizes
+    y_pitch = y[:, :n_pitch_types]
+    y_vertical = y[:, n_pitch_types: n_pitch_types + n_vertical_locs]
+    y_horizontal = y[:, n_pitch_types + n_vertical_locs:]
+    return X, y_pitch, y_vertical, y_horizontal
+
+
+class CompactSequences:
+    """
+    Samples stored as row indices into per-pitch matrices rather than as materialized windows.
+    Memory is O(pitches) for the features plus three integers per sample, and windows are only built for the samples
+    of a batch.
+    Args
+        padded_features: (p + 1, f) per-pitch features whose last row is all zeros.
+        labels: (p, l) per-pitch labels.
+        windows: (s, 3) array of (at_bat_start, start, end) rows.
+        max_length: number of timesteps per window.
+        label_sizes: widths of the pitch, vertical and horizontal labels.
+    """
+    def __init__(self, padded_features, labels, windows, max_length, label_sizes) -> None:
+        self.padded_features = padded_features
+        self.labels = labels
+        self.windows = windows
+        self.max_length = max_length
+        self.label_sizes = label_sizes
+
+    def __len__(self):
+        return len(self.windows)
+
+    def gather(self, indices=None):
+        # Build X, y_pitch, y_vertical, y_horizontal for the given samples (all of them by default)
+        windows = self.windows if indices is None else self.windows[indices]
+        return gather_windows(self.padded_features, self.labels, windows[:, 1], windows[:, 2], self.max_length,
+                              self.label_sizes)
+
+    def label_codes(self):
+        # Pitch type, vertical and horizontal class codes of every sample (-1 where a label is missing), read from the
+        # per-pitch labels without building any window
+        y = self.labels[self.windows[:, 2] - 1]
+        bounds = np.cumsum([0] + list(self.label_sizes))
+        return [class_codes(y[:, start:end]) for start, end in zip(bounds[:-1], bounds[1:])]
+
+    def iter_batches(self, indices=None, batch_size=64):
+        # Generator over (X, y_pitch, y_vertical, y_horizontal) batches
+        indices = np.arange(len(self)) if indices is None else np.asarray(indices)
+        for start in range(0, len(indices), batch_size):
+            yield self.gather(indices[start: start + batch_size])
+
+
 class Sequencer:
     def __init__(self,
                  data: pd.core.frame.DataFrame,
@@ -108,11 +186,187 @@ class Sequencer:
         )
         return all_features, all_pitch_labels, all_vertical_labels, all_horizontal_labels
 
-    def make_sequences(self):
+    def _sorted_arrays(self):
+        """
+        Convert the frame to a float64 matrix and sort it once by plate appearance and pitch number.
+        This mirrors the ordering of the groupby path: groups by ascending plate_app_id, pitches by ascending pitch_number.
+        Returns
+            plate_app_ids: (p,) array of plate appearance ids, sorted.
+            data_arr: (p, c) float64 matrix of the sorted frame.
+        """
+        data_arr = self.data.astype(np.float64).to_numpy()
+        plate_app_col = self.data.columns.get_loc('plate_app_id')
+        pitch_number_col = self.data.columns.get_loc('pitch_number')
+        order = np.lexsort((data_arr[:, pitch_number_col], data_arr[:, plate_app_col]))
+        data_arr = data_arr[order]
+        return data_arr[:, plate_app_col], data_arr
+
+    def _at_bat_bounds(self, plate_app_ids):
+        """
+        Find where each plate appearance starts and ends in the sorted pitch array.
+        Args
+            plate_app_ids: (p,) sorted array of plate appearance ids.
+        Returns
+            starts, ends: (a,) arrays with the first and one-past-last row of every plate appearance.
+        """
+        boundaries = np.flatnonzero(np.diff(plate_app_ids)) + 1
+        starts = np.concatenate(([0], boundaries))
+        ends = np.concatenate((boundaries, [len(plate_app_ids)]))
+        return starts, ends
+
+    @timed('sequencer.window_bounds')
+    def _window_bounds(self, starts, ends, mode='all'):
+        """
+        Build the row bounds of every sample window.
+        With mode='all' this is the vectorized equivalent of _ascending_subsequences followed by _build_sequences:
+        every contiguous slice [i, j) of an at-bat is enumerated in the same order as the reference path (i outer, j inner),
+        and slices longer than max_length are broken into consecutive windows of at most max_length pitches.
+        An at-bat of n pitches gives n(n+1)/2 slices, so this mode grows quadratically with at-bat length.
+        The other modes give one window per pitch, labelled by that pitch:
+            'prefix': the window of the at-bat prefix ending on the pitch, i.e. the last window that 'all' cuts from
+                the slice starting at the first pitch.
+            'sliding': the last max_length pitches up to and including the pitch, which is the window the live
+                inference path (utils.inference.AtBatState) builds.
+        Args
+            starts, ends: output of _at_bat_bounds.
+            mode: 'all', 'prefix' or 'sliding'.
+        Returns
+            window_starts, window_ends: (s,) arrays of global row bounds, one entry per output sample.
+        """
+        length = self.max_length
+        n_pitches = ends[-1] if len(ends) else 0
+        if mode in ('prefix', 'sliding'):
+            window_ends = np.arange(1, n_pitches + 1)
+            at_bat_starts = np.repeat(starts, ends - starts)
+            if mode == 'prefix':
+                window_starts = at_bat_starts + (window_ends - 1 - at_bat_starts) // length * length
+            else:
+                window_starts = np.maximum(at_bat_starts, window_ends - length)
+            return window_starts, window_ends
+        if mode != 'all':
+            raise ValueError(f"mode must be 'all', 'prefix' or 'sliding', got {mode!r}")
+        # For every pitch, the number of slices that start on it is the number of pitches left in its at-bat
+        at_bat_ends = np.repeat(ends, ends - starts)
+        n_slices = at_bat_ends - np.arange(n_pitches)
+        slice_starts = np.repeat(np.arange(n_pitches), n_slices)
+        slice_offsets = np.arange(len(slice_starts)) - np.repeat(np.cumsum(n_slices) - n_slices, n_slices)
+        slice_ends = slice_starts + slice_offsets + 1
+        # Break slices into windows of at most max_length pitches
+        n_windows = (slice_ends - slice_starts + length - 1) // length
+        window_offsets = np.arange(n_windows.sum()) - np.repeat(np.cumsum(n_windows) - n_windows, n_windows)
+        window_starts = np.repeat(slice_starts, n_windows) + window_offsets * length
+        window_ends = np.minimum(window_starts + length, np.repeat(slice_ends, n_windows))
+        return window_starts, window_ends
+
+    def _split_arrays(self, data_arr):
+        """
+        Split the sorted matrix into the per-pitch feature and label matrices.
+        A zero row is appended to the features so that padded timesteps can be gathered like any other row.
+        """
+        n_labels = self.n_pitch_types + self.n_vertical_locs + self.n_horizontal_locs
+        features = data_arr[:, 1: -n_labels]
+        padded_features = np.vstack([features, np.zeros((1, features.shape[1]), dtype=features.dtype)])
+        return padded_features, data_arr[:, -n_labels:]
+
+    @timed('sequencer.gather')
+    def _gather(self, padded_features, labels, window_starts, window_ends):
+        return gather_windows(padded_features, labels, window_starts, window_ends, self.max_length,
+                              (self.n_pitch_types, self.n_vertical_locs, self.n_horizontal_locs))
+
+    @timed('sequencer.make_sequences')
+    def make_sequences(self, mode='all'):
+        # Sort once and find the at-bat boundaries
+        plate_app_ids, data_arr = self._sorted_arrays()
+        starts, ends = self._at_bat_bounds(plate_app_ids)
+        # Build the (start, end) index of every window and gather features and labels in one pass
+        window_starts, window_ends = self._window_bounds(starts, ends, mode)
+        instrumentation.count('sequencer.at_bats', len(starts))
+        instrumentation.count('sequencer.sequences', len(window_starts))
+        padded_features, labels = self._split_arrays(data_arr)
+        return self._gather(padded_features, labels, window_starts, window_ends)
+
+    @timed('sequencer.make_compact')
+    def make_compact(self, mode='all', dtype=None):
+        """
+        Compact alternative to make_sequences: the per-pitch matrices are stored once and every sample is an
+        (at_bat_start, start, end) row index, instead of a copied, padded window.
+        Args
+            mode: window enumeration, see _window_bounds.
+            dtype: optional dtype of the stored features and labels, e.g. 'int8'.
+        Returns
+            CompactSequences whose gather method builds the same samples as make_sequences(mode) for any batch.
+        """
+        plate_app_ids, data_arr = self._sorted_arrays()
+        starts, ends = self._at_bat_bounds(plate_app_ids)
+        window_starts, window_ends = self._window_bounds(starts, ends, mode)
+        instrumentation.count('sequencer.at_bats', len(starts))
+        instrumentation.count('sequencer.sequences', len(window_starts))
+        padded_features, labels = self._split_arrays(data_arr)
+        if dtype is not None:
+            padded_features, labels = padded_features.astype(dtype), labels.astype(dtype)
+        # The at-bat of a window is the one its first pitch belongs to
+        at_bat_starts = np.repeat(starts, ends - starts)[window_starts]
+        windows = np.stack([at_bat_starts, window_starts, window_ends], axis=1).astype(np.int64)
+        return CompactSequences(padded_features, labels, windows, self.max_length,
+                                (self.n_pitch_types, self.n_vertical_locs, self.n_horizontal_locs))
+
+    @timed('sequencer.write_sequences')
+    def write_sequences(self, out_dir, dtype='int8', block_size=65536):
+        """
+        Write the output of make_sequences to memory-mapped .npy files instead of returning float64 arrays.
+        Windows are gathered block_size at a time, so the full float64 tensor is never materialized.
+        The one-hot labels are stored as uint8 and the features as dtype, which must be able to hold every feature value
+        (int8 covers the one-hot columns, the count, the base state and score_diff).
+        Args
+            out_dir: directory for X.npy, y_pitch.npy, y_vertical.npy and y_horizontal.npy.
+            dtype: numpy dtype of X.
+            block_size: number of windows gathered at a time.
+        Returns
+            shapes: the shapes of X, y_pitch, y_vertical and y_horizontal.
+        """
+        plate_app_ids, data_arr = self._sorted_arrays()
+        n_labels = self.n_pitch_types + self.n_vertical_locs + self.n_horizontal_locs
+        features = data_arr[:, 1: -n_labels]
+        check_range(features, dtype)
+
+        starts, ends = self._at_bat_bounds(plate_app_ids)
+        window_starts, window_ends = self._window_bounds(starts, ends)
+        n_samples = len(window_starts)
+        instrumentation.count('sequencer.at_bats', len(starts))
+        instrumentation.count('sequencer.sequences', n_samples)
+
+        os.makedirs(out_dir, exist_ok=True)
+        outputs = [
+            np.lib.format.open_memmap(os.path.join(out_dir, 'X.npy'), mode='w+', dtype=dtype,
+                                      shape=(n_samples, self.max_length, features.shape[1])),
+            np.lib.format.open_memmap(os.path.join(out_dir, 'y_pitch.npy'), mode='w+', dtype=np.uint8,
+                                      shape=(n_samples, self.n_pitch_types)),
+            np.lib.format.open_memmap(os.path.join(out_dir, 'y_vertical.npy'), mode='w+', dtype=np.uint8,
+                                      shape=(n_samples, self.n_vertical_locs)),
+            np.lib.format.open_memmap(os.path.join(out_dir, 'y_horizontal.npy'), mode='w+', dtype=np.uint8,
+                                      shape=(n_samples, self.n_horizontal_locs)),
+        ]
+        padded_features, labels = self._split_arrays(data_arr)
+        for block_start in range(0, n_samples, block_size):
+            block = slice(block_start, block_start + block_size)
+            arrays = self._gather(padded_features, labels, window_starts[block], window_ends[block])
+            for output, array in zip(outputs, arrays):
+                output[block] = array
+        for output in outputs:
+            output.flush()
+        return [output.shape for output in outputs]
+
+    @timed('sequencer.make_sequences_reference')
+    def make_sequences_reference(self):
+        """
+        Original groupby implementation of make_sequences.
+        Kept as the reference the vectorized engine is checked against; it is much slower on large files.
+        """
         # Convert data to float64
         data = self.data.astype(np.float64)
         # Group data by plate_app_id and apply _populate_vectors to each group
-        sequences = data.groupby('plate_app_id').apply(self._populate_vectors)
+        # Grouping by the raw values keeps plate_app_id inside each group on every pandas version
+        sequences = data.groupby(data['plate_app_id'].to_numpy()).apply(self._populate_vectors)
         # Concatenate results from all groups
         X = np.concatenate([result[0] for result in sequences])
         y_pitch = np.concatenate([result[1] for result in sequences])